@@ -18,23 +18,54 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import BackupOperations
-from s3bucketmap import S3BucketMap
-
 # You need to define a localenv module that includes the required data ...
 # Includes definition of "named" backups, each one specifying a source directory
 # and a destination prefix key within the backup bucket.
 import localenv.s3
 import localenv.backups
 
+# If any backup transfers files with greenlets (i.e. has a 'numGreenlets'), the standard library 
+# must be patched before boto (or anything using sockets or threads) is imported
+if any(getattr(backupDetails, "numGreenlets", None) for backupDetails in localenv.backups.backups.values()):
+    from GreenletTaskRunner import patchForGreenlets
+    patchForGreenlets()
+
+import BackupOperations
+from s3bucketmap import S3BucketMap
+from localbucketmap import DirectoryBucketMap
+from RateLimiter import getRateLimiter
+from cachingbucketmap import CachingBucketMap, DiskCache, DefaultCacheSize
+
 testRestoreDir = localenv.backups.testRestoreDir
 print "testRestoreDir = %s" % testRestoreDir
 
 def getBackupMap(backupName):
-    """Get the backup map for the named backup"""
-    backupPrefix = localenv.backups.backups[backupName].prefix
+    """Get the backup map for the named backup, where if the backup has a 'manifestCacheDir', 
+    the manifests of backups are cached there (see CachingBucketMap)"""
+    backupDetails = localenv.backups.backups[backupName]
+    backupMap = getUncachedBackupMap(backupDetails)
+    manifestCacheDir = getattr(backupDetails, "manifestCacheDir", None)
+    if manifestCacheDir is not None:
+        cache = DiskCache(manifestCacheDir, maxSize = getattr(backupDetails, "manifestCacheSize", DefaultCacheSize))
+        backupMap = CachingBucketMap(backupMap, cache)
+    return backupMap
+
+def getUncachedBackupMap(backupDetails):
+    """Get the backup map for a backup (in a local directory if the backup has a 'targetDirectory', 
+    otherwise in the S3 backup bucket, with upload and download rates limited if the backup has
+    an 'uploadRate' or 'uploadSchedule', or a 'downloadRate' or 'downloadSchedule', see RateLimiter)"""
+    backupPrefix = backupDetails.prefix
+    targetDirectory = getattr(backupDetails, "targetDirectory", None)
+    if targetDirectory is not None:
+        return DirectoryBucketMap(targetDirectory, prefix = backupPrefix)
     return S3BucketMap(localenv.s3.accessKey, localenv.s3.secretAccessKey, 
-                       localenv.backups.backupBucket, prefix = backupPrefix)
+                       localenv.backups.backupBucket, prefix = backupPrefix, 
+                       secure = getattr(localenv.s3, "secure", True), 
+                       host = getattr(localenv.s3, "host", None), port = getattr(localenv.s3, "port", None), 
+                       uploadLimiter = getRateLimiter(getattr(backupDetails, "uploadRate", None), 
+                                                      getattr(backupDetails, "uploadSchedule", None)), 
+                       downloadLimiter = getRateLimiter(getattr(backupDetails, "downloadRate", None), 
+                                                        getattr(backupDetails, "downloadSchedule", None)))
 
 def backup(backupName, full, verify, verifyIncrementally = False, doTheBackup = True):
     """Do the named backup, with options for full (or incremental) and verify"""
@@ -44,7 +75,15 @@ def backup(backupName, full, verify, verifyIncrementally = False, doTheBackup =
     BackupOperations.doBackup (backupDetails.source, backupMap, testRestoreDir, full = full, 
                                verify = verify, verifyIncrementally = verifyIncrementally, 
                                doTheBackup = doTheBackup, 
-                               recordTrigger = localenv.backups.recordTrigger)
+                               recordTrigger = localenv.backups.recordTrigger, 
+                               hashCacheFile = getattr(backupDetails, "hashCacheFile", None), 
+                               numHashWorkers = getattr(backupDetails, "numHashWorkers", None), 
+                               chunked = getattr(backupDetails, "chunked", False), 
+                               compression = getattr(backupDetails, "compression", None), 
+                               packSmallFiles = getattr(backupDetails, "packSmallFiles", False), 
+                               writtenIndexFile = getattr(backupDetails, "writtenIndexFile", None), 
+                               maxThreads = getattr(backupDetails, "maxThreads", None), 
+                               numGreenlets = getattr(backupDetails, "numGreenlets", None))
     
 def listBackups(backupName):
     """List all backups in the named backup"""
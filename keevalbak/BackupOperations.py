@@ -19,6 +19,7 @@
 # THE SOFTWARE.
 
 import yaml
+import collections
 import hashlib
 import os
 import time
@@ -26,7 +27,23 @@ import datetime
 import shutil
 import CompareDirectories
 import re
+import multiprocessing
+import multiprocessing.pool
+import threading
+import tempfile
 from sets import Set
+from HashCache import HashCache
+from WrittenIndex import WrittenIndex
+from Manifests import dumpManifest, loadManifest, YamlLoader
+from DirectoryWalker import listDirectory, walkTree
+from ContentChunker import ContentDefinedChunker
+from Codecs import getCodec, CompressionPolicy
+
+# fcntl (not available on Windows) is needed to make reflinks
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 def readFileBytes(filename):
     """Read named file and return contents as a byte string"""
@@ -35,24 +52,92 @@ def readFileBytes(filename):
     f.close()
     return bytes
 
+def readFileChunks(filename, chunkSize = None):
+    """Read named file as a sequence of byte strings of at most chunkSize bytes each
+    (so that the whole file never has to be held in memory at once)"""
+    if chunkSize is None:
+        chunkSize = HashChunkSize
+    f = file(filename, "rb")
+    try:
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
 def writeFileBytes(filename, bytes):
     """Write byte string as new contents of named file"""
     f = file(filename, "wb")
     f.write(bytes)
     f.close()
     
-BackupsVersion = 2
+# Linux ioctl request to make a file share the data of another file (i.e. a reflink) on file systems
+# which support it, e.g. Btrfs or XFS
+FICLONE = 0x40049409
+
+def reflinkFile(sourcePath, destPath):
+    """Make a file which shares the data of another file (until one of them is changed), 
+    raising IOError if the file system doesn't support this"""
+    if fcntl is None:
+        raise IOError("reflinks are not supported on this platform")
+    sourceFile = file(sourcePath, "rb")
+    try:
+        destFile = file(destPath, "wb")
+        try:
+            fcntl.ioctl(destFile.fileno(), FICLONE, sourceFile.fileno())
+        finally:
+            destFile.close()
+    finally:
+        sourceFile.close()
+        
+# Ways to make a restored file which has the same content as a file already restored
+DuplicateMethods = ["copy", "reflink", "hardlink"]
+
+def duplicateFile(sourcePath, destPath, method = "reflink"):
+    """Make a file with the same content as another file, either as a copy, or a reflink (falling back
+    to a copy if the file system doesn't support reflinks), or a hard link (falling back to a copy if 
+    hard links can't be made, e.g. if the files are on different devices)"""
+    if method not in DuplicateMethods:
+        raise ValueError("Unknown duplicate method %r" % method)
+    if method == "hardlink" and hasattr(os, "link"):
+        try:
+            os.link(sourcePath, destPath)
+            return
+        except OSError:
+            pass
+    if method == "reflink":
+        try:
+            reflinkFile(sourcePath, destPath)
+            return
+        except IOError:
+            pass
+    shutil.copyfile(sourcePath, destPath)
+    
+# Size of the blocks in which file contents are read when being hashed
+HashChunkSize = 1024 * 1024
+
+BackupsVersion = 7
+
+# Versions of backups which this version can read 
+# (version 3 added chunked files, version 4 added compressed contents, version 5 added packed files,
+#  version 6 changed manifests from YAML to gzip'd JSON lines, version 7 added writtenPathList and pathList segments)
+ReadableBackupsVersions = [2, 3, 4, 5, 6, 7]
+
+# Number of bytes at the start of a file compressed to decide if compressing the whole file is worthwhile
+CompressionSampleSize = 1024 * 1024
 
 class PathSummary(object):
     """Information about a file or directory specified as a relative path within some base directory
     Note: all paths are '/' separated, whether or not we are in Microsoft Windows"""
     def __init__(self, relativePath):
         self.relativePath = relativePath
-
+    
     def fullPath(self, basePath):
         """Return the full path given the path of the base directory"""
         return basePath + self.relativePath
-
+    
     @staticmethod
     def fromYamlData(data):
         """Convert YAML data into FileSummary or DirSummary (inverse of toYamlData methods)"""
@@ -66,12 +151,17 @@ class PathSummary(object):
 
 class FileSummary(PathSummary):
     """Information about a file specified as a relative path within some (unspecified) base directory, 
-    including a SHA1 hash of the file's contents."""
-    def __init__(self, relativePath, hash):
+    including a SHA1 hash of the file's contents, and, if the contents were written as separate chunks,
+    the list of ChunkKey's where those chunks were written, if the contents were written compressed,
+    the name of the codec used, and if the contents were written as part of a pack, it's PackLocation."""
+    def __init__(self, relativePath, hash, chunks = None, codec = None, pack = None):
         super(FileSummary, self).__init__(relativePath)
         self.isDir = False
         self.isFile = True
         self.hash = hash
+        self.chunks = chunks
+        self.codec = codec
+        self.pack = pack
         
     def __unicode__(self):
         return u"FILE: %r : %s" % (self.relativePath, self.hash)
@@ -81,14 +171,25 @@ class FileSummary(PathSummary):
     
     def toYamlData(self):
         """Convert to YAML"""
-        return {"type": "file", 
+        data = {"type": "file", 
                 "path": self.relativePath, 
                 "hash": self.hash }
+        if self.chunks is not None:
+            data["chunks"] = [chunk.toYamlData() for chunk in self.chunks]
+        if self.codec is not None:
+            data["codec"] = self.codec
+        if self.pack is not None:
+            data["pack"] = self.pack.toYamlData()
+        return data
     
     @staticmethod
     def fromYamlData(data):
         """Create from YAML (inverse of toYamlData)"""
-        return FileSummary(data["path"], data["hash"])
+        chunksData = data.get("chunks")
+        chunks = chunksData is not None and [ChunkKey.fromYamlData(chunkData) for chunkData in chunksData] or None
+        packData = data.get("pack")
+        pack = packData is not None and PackLocation.fromYamlData(packData) or None
+        return FileSummary(data["path"], data["hash"], chunks, data.get("codec"), pack)
 
 class DirSummary(PathSummary):
     """Information about a file specified as a relative path within some (unspecified) base directory"""
@@ -117,25 +218,117 @@ class DirSummary(PathSummary):
 def sha1Digest(content):
     return hashlib.sha1(content).hexdigest()
 
+def sha1DigestOfChunks(chunks):
+    """SHA1 hash of the concatenation of a sequence of byte strings (same result as sha1Digest
+    of the concatenated content, but without ever holding all of the content in memory)"""
+    sha1 = hashlib.sha1()
+    for chunk in chunks:
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+def fileSha1Digest(filename):
+    """SHA1 hash of the contents of a named file, read in blocks of HashChunkSize bytes,
+    so that memory used is independent of the size of the file"""
+    return sha1DigestOfChunks(readFileChunks(filename))
+
+def cachedFileSha1Digest(filename, hashCache = None, statResult = None):
+    """SHA1 hash of the contents of a named file, taken from the hash cache if the file
+    is unchanged since its hash was cached, otherwise read from the file (and then cached).
+    statResult can be passed in if the file's stat details are already known."""
+    if hashCache is None:
+        return fileSha1Digest(filename)
+    if statResult is None:
+        statResult = os.stat(filename)
+    fileHash = hashCache.getHash(filename, statResult)
+    if fileHash is None:
+        fileHash = fileSha1Digest(filename)
+        hashCache.recordHash(filename, statResult, fileHash)
+    return fileHash
+
+# Number of files handed to a hash worker at a time (reduces overhead for lots of small files)
+HashWorkerBatchSize = 8
+
+# Maximum number of paths found ahead of the path summaries yielded when hashing in parallel
+HashLookAheadSize = 1000
+
+def fileSha1Digests(filenames):
+    return [fileSha1Digest(filename) for filename in filenames]
+
+class HashBatch(object):
+    """Files handed to a hash worker together"""
+    def __init__(self):
+        self.fileNames = []
+        self.result = None
+        
+    def add(self, fileName):
+        """Add a file to the batch, returning it's index in the batch"""
+        self.fileNames.append (fileName)
+        return len(self.fileNames) - 1
+    
+    def submitted(self):
+        return self.result is not None
+    
+    def submit(self, pool):
+        self.result = pool.apply_async(fileSha1Digests, (self.fileNames,))
+        
+    def getHash(self, index):
+        """The hash of a file in the batch (waiting for the batch to be hashed)"""
+        return self.result.get()[index]
+
+def createHashWorkerPool(numWorkers, workerType):
+    """Create a pool of "thread" or "process" workers for hashing files"""
+    if workerType == "thread":
+        return multiprocessing.pool.ThreadPool(numWorkers)
+    elif workerType == "process":
+        return multiprocessing.Pool(numWorkers)
+    else:
+        raise ValueError("Unknown hash worker type: %r" % workerType)
+
 class DirectoryInfo:
     """Information about all the directories and files within a base directory
        All directories are listed before any subdirectories or files contained within them.
     """
-    def __init__(self, path):
-        """Construct from path base directory"""
+    def __init__(self, path, hashCache = None, numHashWorkers = None, hashWorkerType = "thread", lazy = False):
+        """Construct from path base directory (with optional HashCache to avoid re-reading unchanged files).
+        If numHashWorkers is given, files are hashed in parallel by a pool of that many
+        workers, where hashWorkerType is "thread" or "process".
+        If lazy is set, the base directory is only summarized as path summaries are requested
+        from iterPathSummaries, otherwise it is summarized straight away."""
         self.path = unicode(path)
+        self.hashCache = hashCache
+        self.numHashWorkers = numHashWorkers
+        self.hashWorkerType = hashWorkerType
         self.pathSummaries = []
-        self.summarizeSubDir(u"")
+        self.summarized = False
+        if not lazy:
+            for pathSummary in self.iterPathSummaries():
+                pass
+            
+    def iterPathSummaries(self):
+        """Yield all the path summaries, summarizing the base directory (if that hasn't already
+        been done) as they are requested"""
+        if self.summarized:
+            for pathSummary in self.pathSummaries:
+                yield pathSummary
+        else:
+            if self.numHashWorkers:
+                pathSummaries = self.summarizeInParallel(self.numHashWorkers, self.hashWorkerType)
+            else:
+                pathSummaries = self.summarizeSubDir(u"")
+            for pathSummary in pathSummaries:
+                self.addSummary(pathSummary)
+                yield pathSummary
+            self.summarized = True
         
     def createDirSummary(self, relativePath):
         """Create a path summary for a sub-directory"""
         return DirSummary (relativePath)
     
-    def createFileSummary(self, relativePath):
-        """Create a path summary for a file in the base directory"""
+    def createFileSummary(self, relativePath, entry = None):
+        """Create a path summary for a file in the base directory (with optional DirectoryEntry for the file)"""
         fileName = self.path + relativePath
-        content = readFileBytes(fileName)
-        fileHash = sha1Digest(content)
+        statResult = entry is not None and self.hashCache is not None and entry.stat() or None
+        fileHash = cachedFileSha1Digest(fileName, self.hashCache, statResult)
         return FileSummary (relativePath, fileHash)
     
     def addSummary(self, pathSummary):
@@ -149,17 +342,65 @@ class DirectoryInfo:
     
     def summarizeSubDir(self, relativePath):
         """Recursively summarize a sub-directory specified by it's relative path, 
-        adding the path summaries for all contained files and sub-directories to the list of path summaries."""
-        for childName in os.listdir(self.path + relativePath):
-            childRelativePath = relativePath + "/" + childName;
-            childPath = self.path + childRelativePath
-            if os.path.isfile(childPath):
-                self.addSummary(self.createFileSummary(childRelativePath))
-            elif os.path.isdir(childPath):
-                self.addSummary(self.createDirSummary(childRelativePath))
-                self.summarizeSubDir (childRelativePath)
+        yielding the path summaries for all contained files and sub-directories."""
+        for childRelativePath, entry in walkTree(self.path, relativePath):
+            if entry.isFile:
+                yield self.createFileSummary(childRelativePath, entry)
+            elif entry.isDir:
+                yield self.createDirSummary(childRelativePath)
             else:
-                print "UNKNOWN OBJECT %r in %r" % (childName, self.path + relativePath)
+                print "UNKNOWN OBJECT %r" % entry.path
+                
+    def summarizeInParallel(self, numHashWorkers, hashWorkerType):
+        """Summarize the whole base directory, hashing files (not found in the hash cache) on a pool of
+        worker threads or processes, while yielding path summaries in the same order as summarizeSubDir.
+        The directory is only walked up to HashLookAheadSize paths ahead of the path summaries yielded, 
+        so that summaries are yielded while the walk continues, without holding all the paths in memory."""
+        print "Hashing files with %d %s workers ..." % (numHashWorkers, hashWorkerType)
+        pool = createHashWorkerPool(numHashWorkers, hashWorkerType)
+        try:
+            pendingPaths = collections.deque() # of (relativePath, isDir, fileHash, statResult, batch, index)
+            batch = HashBatch()
+            for relativePath, entry in walkTree(self.path):
+                if entry.isDir:
+                    pendingPaths.append ((relativePath, True, None, None, None, None))
+                elif not entry.isFile:
+                    print "UNKNOWN OBJECT %r" % entry.path
+                else:
+                    fileName = self.path + relativePath
+                    statResult = None
+                    cachedHash = None
+                    if self.hashCache is not None:
+                        statResult = entry.stat()
+                        cachedHash = self.hashCache.getHash(fileName, statResult)
+                    if cachedHash is not None:
+                        pendingPaths.append ((relativePath, False, cachedHash, None, None, None))
+                    else:
+                        if batch.submitted() or len(batch.fileNames) >= HashWorkerBatchSize:
+                            if not batch.submitted():
+                                batch.submit(pool)
+                            batch = HashBatch()
+                        pendingPaths.append ((relativePath, False, None, statResult, batch, batch.add(fileName)))
+                while len(pendingPaths) > HashLookAheadSize:
+                    yield self.pendingPathSummary(pendingPaths.popleft(), pool)
+            while len(pendingPaths) > 0:
+                yield self.pendingPathSummary(pendingPaths.popleft(), pool)
+        finally:
+            pool.close()
+            pool.join()
+            
+    def pendingPathSummary(self, pendingPath, pool):
+        """The path summary of a path found by summarizeInParallel (waiting for it's hash if necessary)"""
+        relativePath, isDir, fileHash, statResult, batch, index = pendingPath
+        if isDir:
+            return self.createDirSummary(relativePath)
+        if fileHash is None:
+            if not batch.submitted():
+                batch.submit(pool)
+            fileHash = batch.getHash(index)
+            if self.hashCache is not None:
+                self.hashCache.recordHash(self.path + relativePath, statResult, fileHash)
+        return FileSummary(relativePath, fileHash)
                 
 class HashVerificationRecords(object):
     """Records of verified hashes of backed up files (i.e. verified by actually reading
@@ -176,11 +417,17 @@ class HashVerificationRecords(object):
         if datetime in self.datetimeFileHashesMap:
             fileHashesMap = self.datetimeFileHashesMap[datetime]
         else:
-            fileHashesRecordFilename = datetime + "/verifiedFileHashes.yaml"
-            if fileHashesRecordFilename in self.backupMap:
-                fileHashesMap = yaml.safe_load(self.backupMap[fileHashesRecordFilename])
+            fileHashesRecordFilename = datetime + "/verifiedFileHashes"
+            oldFileHashesRecordFilename = datetime + "/verifiedFileHashes.yaml"
+            fileHashesRecord = self.backupMap.get(fileHashesRecordFilename)
+            if fileHashesRecord is not None:
+                fileHashesMap = dict(loadManifest(fileHashesRecord))
             else:
-                fileHashesMap = {}
+                oldFileHashesRecord = self.backupMap.get(oldFileHashesRecordFilename)
+                if oldFileHashesRecord is not None:
+                    fileHashesMap = yaml.load(oldFileHashesRecord, Loader = YamlLoader)
+                else:
+                    fileHashesMap = {}
             self.datetimeFileHashesMap[datetime] = fileHashesMap
         return fileHashesMap
         
@@ -189,15 +436,23 @@ class HashVerificationRecords(object):
         fileHashesMap[filePath] = contentHash
         self.datetimeUpdated.add (datetime)
         
-    def getWrittenFileHash(self, datetime, filePath):
+    def getWrittenFileHash(self, contentKey):
         """Get the hash of a backed up file, either from an existing hash verification record, 
-        or, read the file contents from the backup map and calculate the hash."""
+        or, read the file contents (or it's chunks) from the backup map and calculate the hash."""
+        datetime, filePath = contentKey.datetime, contentKey.filePath
         fileHashesMap = self.getFileHashesMap(datetime)
         if filePath in fileHashesMap:
             return fileHashesMap[filePath]
         else:
-            content = self.backupMap[datetime + "/files" + filePath]
-            contentHash = sha1Digest(content)
+            if contentKey.chunks is not None:
+                contentHash = sha1DigestOfChunks(chunk.getContent(self.backupMap) for chunk in contentKey.chunks)
+            elif contentKey.pack is not None:
+                contentHash = sha1Digest(contentKey.pack.getContent(self.backupMap, contentKey.codec))
+            else:
+                content = self.backupMap[contentKey.fileKey()]
+                if contentKey.codec is not None:
+                    content = getCodec(contentKey.codec).decode(content)
+                contentHash = sha1Digest(content)
             self.markVerified(datetime, filePath, contentHash)
             return contentHash
         
@@ -205,10 +460,10 @@ class HashVerificationRecords(object):
         """Update any newly verified hashes back into the backup map."""
         print "Verified hashes were updated for %r" % self.datetimeUpdated
         for datetime in self.datetimeUpdated:
-            fileHashesRecordFilename = datetime + "/verifiedFileHashes.yaml"
+            fileHashesRecordFilename = datetime + "/verifiedFileHashes"
             print "Updating verification records for %s = %s" % (datetime, 
                                                                  self.datetimeFileHashesMap[datetime])
-            self.backupMap[fileHashesRecordFilename] = yaml.safe_dump (self.datetimeFileHashesMap[datetime])
+            self.backupMap[fileHashesRecordFilename] = dumpManifest (sorted(self.datetimeFileHashesMap[datetime].iteritems()))
             
 class BackupRecord:
     """A record of a backup made: it's date/time, and whether it was full or incremental."""
@@ -217,7 +472,7 @@ class BackupRecord:
         self.type = type
         self.datetime = datetime
         self.completed = completed
-
+    
     @staticmethod
     def fromYamlData(data):
         """Construct backup record from YAML data (inverse of toYamlData)"""
@@ -239,33 +494,77 @@ class BackupRecord:
     
 class InvalidBackupsVersion(Exception):
     def __init__(self, backupRecord, version):
-        Exception.__init__(self, "Invalid backup for backup record %s version %d (this version = %d)" % 
-                           (backupRecord, version, BackupsVersion))
+        Exception.__init__(self, "Invalid backup for backup record %s version %d (this version = %d, can read %r)" % 
+                           (backupRecord, version, BackupsVersion, ReadableBackupsVersions))
         self.version = version
     
 def getBackupsVersion(backupMap, backupRecord):
-    versionKey = backupRecord.datetime + "/version"
-    if versionKey in backupMap:
-        return int(backupMap[versionKey])
+    version = backupMap.get(backupRecord.datetime + "/version")
+    if version is not None:
+        return int(version)
     else:
         return 1
         
 def checkVersion(backupMap, backupRecord):
     version = getBackupsVersion (backupMap, backupRecord)
-    if version != BackupsVersion:
+    if version not in ReadableBackupsVersions:
         raise InvalidBackupsVersion (backupRecord, version)
     
+def writtenPathListSegmentKey(backupKeyBase, segmentNumber):
+    return "%s/writtenPathList/%06d" % (backupKeyBase, segmentNumber)
+
+def pathListSegmentKey(backupKeyBase, segmentNumber):
+    return "%s/pathList/%06d" % (backupKeyBase, segmentNumber)
+
+def getManifestOrSegmentsData(backupMap, manifestKey):
+    """Get the YAML data of a manifest, or if it hasn't been recorded (yet), the concatenated
+    data of it's segments (with keys manifestKey + "/" + segment number)"""
+    manifest = backupMap.get(manifestKey)
+    if manifest is not None:
+        return loadManifest(manifest)
+    segmentsMap = backupMap.subMap(manifestKey + "/")
+    data = []
+    for segmentKey in sorted(segmentsMap):
+        data += loadManifest(segmentsMap[segmentKey])
+    return data
+
+def getPathSummariesData(backupMap, backupKeyBase):
+    """Get the YAML data of the path summaries of a backup, either from the single pathList 
+    (for a completed backup) or else from the concatenated pathList segments recorded at
+    each checkpoint (for a backup still in progress, or one that was never completed)"""
+    return getManifestOrSegmentsData(backupMap, backupKeyBase + "/pathList")
+
+def getWrittenFileSummariesData(backupMap, backupKeyBase):
+    """Get the YAML data of the file summaries written in a backup, either from the single
+    writtenPathList (for a completed backup) or else from the concatenated writtenPathList segments
+    recorded at each checkpoint (for a backup still in progress, or one that was never completed)"""
+    return getManifestOrSegmentsData(backupMap, backupKeyBase + "/writtenPathList")
+
 class WrittenRecords:
     """Records of where file contents with a given SHA1 hash value was written to in backup map
     (within the context of a particular set of backups, i.e. a full and following incrementals)"""
     def __init__(self):
         self.written = {}
+        self.writtenChunks = {}
+        self.chunksLock = threading.Lock()
         
     def recordHashWritten(self, hash, key):
         """Record that a contents with a particular hash were written to a particular key"""
         print " record hash %s written to %r" % (hash, key)
         self.written[hash] = key
         
+    def recordChunkWritten(self, chunkKey):
+        """Record that a chunk of file contents was written to the location given by a ChunkKey
+        (can be called from any thread)"""
+        with self.chunksLock:
+            self.writtenChunks[chunkKey.hash] = chunkKey
+            
+    def chunkLocationWritten(self, hash):
+        """Where a chunk with this hash value was written to, or None if it hasn't been written
+        (can be called from any thread)"""
+        with self.chunksLock:
+            return self.writtenChunks.get(hash)
+        
     def isWritten(self, hash):
         """Has a file contents with this hash value been written to the backup map?"""
         return hash in self.written
@@ -274,28 +573,50 @@ class WrittenRecords:
         """Where a file contents with this hash value was written to"""
         return self.written[hash]
     
-    def recordBackup(self, backupMap, backupRecord):
+    def recordBackup(self, backupMap, backupRecord, writtenIndex = None):
         """For every file contents in a backup record recorded as written, record it's
-        hash value and backup map key in the written records.""" # todo: slow
+        hash value and backup map key in the written records (and in the written index, if given)."""
         checkVersion(backupMap, backupRecord)
-        writtenPathListKey = backupRecord.datetime + "/writtenPathList"
-        writtenFileSummariesYamlData = yaml.safe_load (backupMap[writtenPathListKey])
+        writtenFileSummariesYamlData = getWrittenFileSummariesData (backupMap, backupRecord.datetime)
         for fileData in writtenFileSummariesYamlData:
             #print "Recording backup data %s/%r" % (backupRecord.datetime, pathData)
             self.recordHashWritten (fileData["hash"], backupRecord.datetime + fileData["path"])
+            for chunkData in fileData.get("chunks", []):
+                self.recordChunkWritten (ChunkKey.fromYamlData(chunkData))
+        if writtenIndex is not None:
+            writtenIndex.recordFileSummaries (backupRecord.datetime, writtenFileSummariesYamlData)
+            writtenIndex.recordIndexed (backupRecord.datetime, backupRecord.completed)
+                    
+    def recordIndexedBackups(self, writtenIndex):
+        """Record everything held in a (validated) written index"""
+        for hash, datetime, path in writtenIndex.writtenEntries():
+            self.written[hash] = datetime + path
+        for hash, datetime, codec in writtenIndex.chunkEntries():
+            self.writtenChunks[hash] = ChunkKey(datetime, hash, codec)
+        print "Recorded %d files and %d chunks from written index" % (len(self.written), len(self.writtenChunks))
     
-    def recordPreviousBackups(self, backupMap, backupRecords):
+    def recordPreviousBackups(self, backupMap, backupRecords, writtenIndex = None):
         """Record the hashes of all files written from the last full backup onwards (or from the first
-        backup if for some reason there is no full backup."""
-        fullFound = False
+        backup if for some reason there is no full backup.
+        If a written index is given, only backups not already held in the index are read from the
+        backup map (and added to the index)."""
+        groupRecords = []
         i = len(backupRecords)-1
-        while not fullFound and i >= 0:
-            backupRecord = backupRecords[i]
-            print "Recording backup %r ..." % backupRecord
-            self.recordBackup(backupMap, backupRecord)
-            if backupRecord.type == "full":
-                fullFound = True
+        while i >= 0:
+            groupRecords.insert(0, backupRecords[i])
+            if backupRecords[i].type == "full":
+                break
             i -= 1
+        if writtenIndex is not None:
+            recordsToRead = writtenIndex.validate(groupRecords)
+            self.recordIndexedBackups(writtenIndex)
+        else:
+            recordsToRead = groupRecords
+        for backupRecord in recordsToRead:
+            print "Recording backup %r ..." % backupRecord
+            self.recordBackup(backupMap, backupRecord, writtenIndex)
+        if writtenIndex is not None:
+            writtenIndex.commit()
             
 class BaseFileHash(object):
     """Description of a file: it's (basic) name and hash"""
@@ -420,30 +741,77 @@ class BaseDirHash(object):
 class FileHash(BaseFileHash):
     """Information about a file with a relative path name based on actual
     contents of actual file in actual file-system base directory"""
-    def __init__(self, dir, name, description):
+    def __init__(self, dir, name, description, hashCache = None, statResult = None):
         filename = dir + "/" + name
-        content = readFileBytes (filename)
-        super(FileHash, self).__init__(name, sha1Digest(content), description)
+        super(FileHash, self).__init__(name, cachedFileSha1Digest(filename, hashCache, statResult), description)
         
 class DirHash(BaseDirHash):
     """Information about files within a directory with a relative path name 
     based on actual contents of actual directory in actual file-system base directory"""
-    def __init__(self, dir, name, description):
+    def __init__(self, dir, name, description, hashCache = None):
         super(DirHash, self).__init__(name, description)
         fullPath = unicode (name and (dir + "/" + name) or dir)
-        for childName in os.listdir(fullPath):
-            childPath = fullPath + "/" + childName
-            if os.path.isfile(childPath):
-                self.addChild (FileHash(fullPath, childName, self.description))
+        for entry in listDirectory(fullPath):
+            if entry.isFile:
+                statResult = hashCache is not None and entry.stat() or None
+                self.addChild (FileHash(fullPath, entry.name, self.description, hashCache, statResult))
+            elif entry.isDir:
+                self.addChild (DirHash(fullPath, entry.name, self.description, hashCache))
             else:
-                self.addChild (DirHash(fullPath, childName, self.description))
+                print "UNKNOWN OBJECT %r" % entry.path
                 
+def writeFileContent(backupMap, key, fileName, compressionPolicy = None):
+    """Write the contents of a named file to a key in a backup map, compressed with the
+    codec given by the compression policy if that is worthwhile. Return the name of the
+    codec used, or None if the contents were written as is."""
+    codec = compressionPolicy is not None and compressionPolicy.codecForFile(fileName) or None
+    if codec is not None:
+        f = file(fileName, "rb")
+        try:
+            sample = f.read(CompressionSampleSize)
+        finally:
+            f.close()
+        encodedSample = codec.encode(sample)
+        if not compressionPolicy.worthwhile(len(sample), len(encodedSample)):
+            codec = None
+        elif len(sample) < CompressionSampleSize:
+            backupMap[key] = encodedSample
+            return codec.name
+    if codec is None:
+        backupMap.setFromFile(key, fileName)
+        return None
+    fd, encodedFileName = tempfile.mkstemp(prefix = "keevalbak-")
+    try:
+        encodedFile = os.fdopen(fd, "wb")
+        try:
+            f = file(fileName, "rb")
+            try:
+                encodedSize = codec.encodeStream(f, encodedFile)
+            finally:
+                f.close()
+        finally:
+            encodedFile.close()
+        if compressionPolicy.worthwhile(os.path.getsize(fileName), encodedSize):
+            backupMap.setFromFile(key, encodedFileName)
+            return codec.name
+        else:
+            backupMap.setFromFile(key, fileName)
+            return None
+    finally:
+        os.remove(encodedFileName)
+
 class ContentKey(object):
-    def __init__(self, datetime, filePath):
+    def __init__(self, datetime, filePath, chunks = None, codec = None, pack = None):
         """Parameters for key used to look up file contents from a particular backup within a backup map.
-        Note that filePath is expected to start with a '/'"""
+        Note that filePath is expected to start with a '/'.
+        If the contents were written as chunks, chunks is the list of ChunkKey's for the chunks, 
+        if they were written compressed, codec is the name of the codec, and if they
+        were written into a pack, pack is the PackLocation."""
         self.datetime = datetime
         self.filePath = filePath
+        self.chunks = chunks
+        self.codec = codec
+        self.pack = pack
         
     def fileKey(self):
         """The actual key.
@@ -451,15 +819,96 @@ class ContentKey(object):
         return self.datetime + "/files" + self.filePath
     
     def __str__(self):
+        if self.chunks is not None:
+            return "[%s:%r (%d chunks)]" % (self.datetime, self.filePath, len(self.chunks))
+        if self.pack is not None:
+            return "[%s:%r in %s]" % (self.datetime, self.filePath, self.pack)
         return "[%s:%r]" % (self.datetime, self.filePath)
     
     def __repr__(self):
         return self.__str__()
     
+class ChunkKey(object):
+    def __init__(self, datetime, hash, codec = None):
+        """Parameters for key used to look up a chunk of file contents (with given SHA1 hash) 
+        from a particular backup within a backup map, and the name of the codec used to compress it (if any)."""
+        self.datetime = datetime
+        self.hash = hash
+        self.codec = codec
+        
+    def chunkKey(self):
+        """The actual key"""
+        if self.codec is not None:
+            return self.datetime + "/chunks/" + self.hash + "." + self.codec
+        return self.datetime + "/chunks/" + self.hash
+    
+    def getContent(self, backupMap):
+        """Read the (decoded) chunk contents from the backup map"""
+        content = backupMap[self.chunkKey()]
+        if self.codec is not None:
+            content = getCodec(self.codec).decode(content)
+        return content
+    
+    def toYamlData(self):
+        if self.codec is not None:
+            return [self.datetime, self.hash, self.codec]
+        return [self.datetime, self.hash]
+    
+    @staticmethod
+    def fromYamlData(data):
+        return ChunkKey(data[0], data[1], len(data) > 2 and data[2] or None)
+    
+    def __str__(self):
+        return "[%s:chunk %s]" % (self.datetime, self.hash)
+    
+    def __repr__(self):
+        return self.__str__()
+    
+class PackLocation(object):
+    def __init__(self, datetime, packNumber, offset, length):
+        """Location of (possibly compressed) file contents written as the bytes [offset, offset+length) 
+        of a numbered pack (i.e. a single value containing the contents of many small files) 
+        in a particular backup within a backup map"""
+        self.datetime = datetime
+        self.packNumber = packNumber
+        self.offset = offset
+        self.length = length
+        
+    def packKey(self):
+        """The actual key of the pack"""
+        return "%s/packs/%06d" % (self.datetime, self.packNumber)
+    
+    def getContent(self, backupMap, codec = None):
+        """Read the (decoded) contents from the pack in the backup map"""
+        content = backupMap.getRange(self.packKey(), self.offset, self.offset + self.length)
+        if codec is not None:
+            content = getCodec(codec).decode(content)
+        return content
+    
+    def toYamlData(self):
+        return [self.datetime, self.packNumber, self.offset, self.length]
+    
+    @staticmethod
+    def fromYamlData(data):
+        return PackLocation(data[0], data[1], data[2], data[3])
+    
+    def __str__(self):
+        return "[%s:pack %d %d+%d]" % (self.datetime, self.packNumber, self.offset, self.length)
+    
+    def __repr__(self):
+        return self.__str__()
+    
+class PackPolicy(object):
+    """Which files are packed together when backing up: files of at most maxMemberSize bytes are
+    written together in packs which are closed once they contain at least packSize bytes."""
+    def __init__(self, maxMemberSize = 256 * 1024, packSize = 8 * 1024 * 1024):
+        self.maxMemberSize = maxMemberSize
+        self.packSize = packSize
+    
 class BackupRecordUpdater:
     """Object responsible for recording current state of backup in progress"""
     def __init__(self, backups, backupRecords, currentBackupRecord, backupKeyBase, 
-                 directoryInfo, recordTrigger = 1000000):
+                 directoryInfo, recordTrigger = 1000000, writtenIndex = None):
         self.backups = backups
         self.backupRecords = backupRecords
         self.currentBackupRecord = currentBackupRecord
@@ -469,67 +918,168 @@ class BackupRecordUpdater:
         self.unrecordedBytes = 0
         self.recordTrigger = recordTrigger
         self.writtenFileSummaries = []
+        self.numRecordedFileSummaries = 0
+        self.numSegments = 0
+        self.writtenIndex = writtenIndex
+        self.numIndexedFileSummaries = 0
+        self.pathSummariesRecorded = False
+        self.numRecordedPathSummaries = 0
+        self.numPathSegments = 0
         
     def recordVersion(self):
         self.backups.backupMap[self.backupKeyBase + "/version"] = str(BackupsVersion)
         
     def recordPathSummaries(self):
         self.backups.recordPathSummaries (self.backupKeyBase, self.directoryInfo)
+        self.pathSummariesRecorded = True
         
-    def recordWrittenFileSummaries(self):
+    def recordPathSummariesSegment(self):
+        """Record the path summaries found since the last segment as the next segment 
+        (unless all the path summaries have been recorded already)"""
+        if not self.pathSummariesRecorded:
+            newPathSummaries = self.directoryInfo.pathSummaries[self.numRecordedPathSummaries:]
+            if len(newPathSummaries) > 0:
+                self.backups.recordPathSummariesSegment (self.backupKeyBase, self.numPathSegments, newPathSummaries)
+                self.numPathSegments += 1
+                self.numRecordedPathSummaries += len(newPathSummaries)
+                
+    def recordWrittenFileSummariesSegment(self):
+        """Record the file summaries written since the last segment as the next segment"""
+        newFileSummaries = self.writtenFileSummaries[self.numRecordedFileSummaries:]
+        if len(newFileSummaries) > 0:
+            self.backups.recordWrittenFileSummariesSegment (self.backupKeyBase, self.numSegments, newFileSummaries)
+            self.numSegments += 1
+            self.numRecordedFileSummaries += len(newFileSummaries)
+            
+    def compactWrittenFileSummaries(self):
+        """Record all the written file summaries as one writtenPathList, replacing any segments"""
         self.backups.recordWrittenFileSummaries (self.backupKeyBase, self.writtenFileSummaries)
+        self.numRecordedFileSummaries = len(self.writtenFileSummaries)
         
     def saveBackupRecords(self):
         self.backups.saveBackupRecords(self.backupRecords)
         
+    def updateWrittenIndex(self):
+        """Add file summaries written (and recorded in the backup map) since the last update to the written index"""
+        if self.writtenIndex is not None:
+            newFileSummaries = self.writtenFileSummaries[self.numIndexedFileSummaries:]
+            self.writtenIndex.recordFileSummaries (self.backupKeyBase, 
+                                                   [fileSummary.toYamlData() for fileSummary in newFileSummaries])
+            self.writtenIndex.recordIndexed (self.backupKeyBase, self.currentBackupRecord.completed)
+            self.writtenIndex.commit()
+            self.numIndexedFileSummaries += len(newFileSummaries)
+        
     def checkpoint(self):
-        self.recordWrittenFileSummaries()
+        """Record the path summaries and written file summaries found so far (as segments), so that 
+        an interrupted backup can still be restored (with allowIncomplete), and so that a following
+        incremental backup doesn't write the same file contents again"""
+        self.recordPathSummariesSegment()
+        self.recordWrittenFileSummariesSegment()
+        self.updateWrittenIndex()
         
     def initialRecord(self):
+        """Record the start of the backup (and the path summaries, if the source directory 
+        has already been summarized, otherwise they are recorded as segments at each checkpoint, 
+        and then all together when the backup is completed)"""
         self.recordVersion()
-        self.recordPathSummaries()
-        self.recordWrittenFileSummaries()
+        if self.directoryInfo.summarized:
+            self.recordPathSummaries()
         self.saveBackupRecords()
         
     def recordCompleted(self):
+        if not self.pathSummariesRecorded:
+            self.recordPathSummaries()
         self.currentBackupRecord.completed = True
-        self.recordWrittenFileSummaries()
+        self.compactWrittenFileSummaries()
         self.saveBackupRecords()
+        if self.numSegments > 0:
+            self.backups.deleteWrittenFileSummariesSegments (self.backupKeyBase)
+        if self.numPathSegments > 0:
+            self.backups.deletePathSummariesSegments (self.backupKeyBase)
+        self.updateWrittenIndex()
         
-from ThreadedTaskRunner import ThreadedTaskRunner, TaskRunner
+from ThreadedTaskRunner import ThreadedTaskRunner, TaskRunner, TasksFailed, AdaptiveConcurrency
 
 #taskRunner = TaskRunner(checkpointFreq = 30)
 
 taskRunner = ThreadedTaskRunner (checkpointFreq =  500, numThreads = 30)
 
-class DeleteBackupMapValueTask:
-    def __init__(self, backupMap, key):
+# The settings which the current task runner was created with (None for the default task runner)
+taskRunnerSettings = None
+
+def replaceTaskRunner(settings, createTaskRunner):
+    """Replace the task runner with one created by createTaskRunner(), stopping the worker threads
+    of the one replaced, unless the current task runner was already created with the same settings"""
+    global taskRunner, taskRunnerSettings
+    if settings == taskRunnerSettings:
+        return
+    taskRunner.shutdown()
+    taskRunner = createTaskRunner()
+    taskRunnerSettings = settings
+    
+def useAdaptiveTaskRunner(minThreads = 4, maxThreads = 128):
+    """Replace the task runner with one which adapts the number of tasks run at once (see AdaptiveConcurrency)"""
+    minThreads = min(minThreads, maxThreads)
+    replaceTaskRunner (("adaptive", minThreads, maxThreads), 
+                       lambda: ThreadedTaskRunner (checkpointFreq = 500, numThreads = maxThreads, 
+                                                   concurrency = AdaptiveConcurrency(minWorkers = minThreads, 
+                                                                                     maxWorkers = maxThreads)))
+    
+def useGreenletTaskRunner(numGreenlets = 200):
+    """Replace the task runner with one running tasks on greenlets (see GreenletTaskRunner, 
+    which requires GreenletTaskRunner.patchForGreenlets to have been called at program start)"""
+    from GreenletTaskRunner import GreenletTaskRunner
+    replaceTaskRunner (("greenlets", numGreenlets), 
+                       lambda: GreenletTaskRunner (checkpointFreq = 500, numGreenlets = numGreenlets))
+
+# Number of keys deleted by each task deleting values from a map (at most the number S3 can delete in one request)
+DeleteBatchSize = 1000
+
+class DeleteBackupMapValuesTask:
+    def __init__(self, backupMap, keys):
         self.backupMap = backupMap
-        self.key = key
-        
-    def getThreadLocals(self):
-        return {"backupMap": self.backupMap.clone()}
+        self.keys = keys
         
+    def __repr__(self):
+        return "<DeleteBackupMapValuesTask %d keys from %r>" % (len(self.keys), self.keys[0])
+    
     def doUnsynchronized(self):
-        print " delete %r ..." % self.key
-        del self.backupMap[self.key]
+        print " delete %d keys %r ... %r ..." % (len(self.keys), self.keys[0], self.keys[-1])
+        self.backupMap.deleteMany(self.keys)
         
     def doSynchronized(self):
         pass
+    
+def generateDeleteTasks(backupMap):
+    """Tasks deleting batches of DeleteBatchSize keys, as the keys are listed"""
+    keys = []
+    for key in backupMap:
+        keys.append (key)
+        if len(keys) >= DeleteBatchSize:
+            yield DeleteBackupMapValuesTask(backupMap, keys)
+            keys = []
+    if keys:
+        yield DeleteBackupMapValuesTask(backupMap, keys)
         
 def deleteMapValues(backupMap, dryRun):
-    """Delete all keys from a map, or if dryRun is True, do a dry run"""
+    """Delete all keys from a map (in batches, deleted in parallel while the map is still being listed), 
+    or if dryRun is True, do a dry run"""
     print "%sDeleting keys from map %s" % (dryRun and "DRYRUN: " or "", backupMap)
-    deleteTasks = []
-    for key in backupMap:
-        if dryRun:
+    if dryRun:
+        for key in backupMap:
             print " delete %r ..." % key
-        else:
-            deleteTasks.append (DeleteBackupMapValueTask(backupMap, key))
-    if not dryRun:
-        taskRunner.runTasks (deleteTasks)
+    else:
+        taskRunner.runTaskStream (generateDeleteTasks(backupMap))
     print "finished."
     
+def restoreDuplicates(fullPath, duplicatePaths, duplicateMethod, overwrite):
+    """Make restored files with the same content as a restored file"""
+    for duplicatePath in duplicatePaths:
+        if os.path.exists(duplicatePath) and overwrite:
+            os.remove (duplicatePath)
+        duplicateFile(fullPath, duplicatePath, duplicateMethod)
+        print "Restored FILE %r (same content as %r)" % (duplicatePath, fullPath)
+        
 class IncrementalBackups:
     """A set of dated full or incremental backups within a given backup map.
     This object does _not_ (currently) record _where_ the file contents came from.
@@ -544,15 +1094,16 @@ class IncrementalBackups:
     
     def getBackupRecords(self):
         """Retrieve the BackupRecord objects describing any existing backups"""
-        if "backupRecords" in self.backupMap:
-            backupsListYamlData = yaml.safe_load(self.backupMap["backupRecords"])
+        backupRecords = self.backupMap.get("backupRecords")
+        if backupRecords is not None:
+            backupsListYamlData = loadManifest(backupRecords)
         else:
             backupsListYamlData = []
         return [BackupRecord.fromYamlData(record) for record in backupsListYamlData]
     
     def saveBackupRecords(self, backupRecords):
         backupRecordsYamlData = [record.toYamlData() for record in backupRecords]
-        self.backupMap["backupRecords"] = yaml.safe_dump(backupRecordsYamlData)
+        self.backupMap["backupRecords"] = dumpManifest(backupRecordsYamlData)
         print "new backup records = %r" % backupRecords
     
     def getBackupGroups(self):
@@ -617,55 +1168,184 @@ class IncrementalBackups:
     def recordPathSummaries(self, backupKeyBase, directoryInfo):
         pathListKey = backupKeyBase + "/pathList"
         print "Record path summaries to %s ..." % pathListKey
-        self.backupMap[pathListKey] = yaml.safe_dump(directoryInfo.getPathSummariesYamlData())
-
+        self.backupMap[pathListKey] = dumpManifest(directoryInfo.getPathSummariesYamlData())
+    
+    def recordPathSummariesSegment(self, backupKeyBase, segmentNumber, pathSummaries):
+        segmentKey = pathListSegmentKey(backupKeyBase, segmentNumber)
+        print "Record %d path summaries to %s ..." % (len(pathSummaries), segmentKey)
+        self.backupMap[segmentKey] = dumpManifest([summary.toYamlData() for summary in pathSummaries])
+        
+    def deletePathSummariesSegments(self, backupKeyBase):
+        """Delete the pathList segments of a backup (once all the path summaries have been recorded in one pathList)"""
+        deleteMapValues(self.backupMap.subMap(backupKeyBase + "/pathList/"), dryRun = False)
+        
     def recordWrittenFileSummaries(self, backupKeyBase, writtenFileSummaries):
         writtenPathListKey = backupKeyBase + "/writtenPathList"
         print "Record written file summaries to %s ..." % writtenPathListKey
         writtenFileSummariesYamlData = [summary.toYamlData() for summary in writtenFileSummaries]
-        self.backupMap[writtenPathListKey] = yaml.safe_dump(writtenFileSummariesYamlData)
+        self.backupMap[writtenPathListKey] = dumpManifest(writtenFileSummariesYamlData)
+        
+    def recordWrittenFileSummariesSegment(self, backupKeyBase, segmentNumber, writtenFileSummaries):
+        segmentKey = writtenPathListSegmentKey(backupKeyBase, segmentNumber)
+        print "Record %d written file summaries to %s ..." % (len(writtenFileSummaries), segmentKey)
+        self.backupMap[segmentKey] = dumpManifest([summary.toYamlData() for summary in writtenFileSummaries])
+        
+    def deleteWrittenFileSummariesSegments(self, backupKeyBase):
+        """Delete the writtenPathList segments of a backup (once they have been compacted into one writtenPathList)"""
+        deleteMapValues(self.backupMap.subMap(backupKeyBase + "/writtenPathList/"), dryRun = False)
         
     class BackupFileTask:
         def __init__(self, backupMap, backupFilesKeyBase, pathSummary, fileName, writtenRecords, 
-                     writtenFileSummaries):
+                     writtenFileSummaries, compressionPolicy = None):
             self.backupMap = backupMap
             self.backupFilesKeyBase = backupFilesKeyBase
             self.pathSummary = pathSummary
             self.fileName = fileName
             self.writtenRecords = writtenRecords
             self.writtenFileSummaries = writtenFileSummaries
+            self.compressionPolicy = compressionPolicy
             
-        def getThreadLocals(self):
-            return {"backupMap": self.backupMap.clone()}
+        def __repr__(self):
+            return "<BackupFileTask %r>" % self.fileName
         
         def doUnsynchronized(self):
-            content = readFileBytes(self.fileName)
             self.fileContentKey = self.backupFilesKeyBase + self.pathSummary.relativePath
             print "Writing %r ..." % self.fileContentKey
-            self.backupMap[self.fileContentKey] = content
+            self.codecName = writeFileContent(self.backupMap, self.fileContentKey, self.fileName, 
+                                              self.compressionPolicy)
             
         def doSynchronized(self):
-            self.writtenFileSummaries.append (self.pathSummary)
+            if self.codecName is None:
+                writtenFileSummary = self.pathSummary
+            else:
+                writtenFileSummary = FileSummary(self.pathSummary.relativePath, self.pathSummary.hash, 
+                                                 codec = self.codecName)
+            self.writtenFileSummaries.append (writtenFileSummary)
             self.writtenRecords.recordHashWritten (self.pathSummary.hash, self.fileContentKey)
             
-    def doBackup(self, directoryInfo, full = True):
+    class PackBackupTask:
+        """Task to back up a number of small files by writing their contents together as one pack.
+        Files with identical contents within the same pack are only written once."""
+        def __init__(self, backupMap, backupKeyBase, packNumber, members, writtenRecords, 
+                     writtenFileSummaries, compressionPolicy = None):
+            self.backupMap = backupMap
+            self.backupKeyBase = backupKeyBase
+            self.packNumber = packNumber
+            self.members = members # list of (pathSummary, fileName)
+            self.writtenRecords = writtenRecords
+            self.writtenFileSummaries = writtenFileSummaries
+            self.compressionPolicy = compressionPolicy
+            
+        def __repr__(self):
+            return "<PackBackupTask %d (%d files)>" % (self.packNumber, len(self.members))
+        
+        def doUnsynchronized(self):
+            contents = []
+            offset = 0
+            self.memberSummaries = []
+            locationsByHash = {}
+            for pathSummary, fileName in self.members:
+                if pathSummary.hash in locationsByHash:
+                    pack, codecName = locationsByHash[pathSummary.hash]
+                else:
+                    content = readFileBytes(fileName)
+                    codecName = None
+                    codec = self.compressionPolicy is not None and self.compressionPolicy.codecForFile(fileName) or None
+                    if codec is not None:
+                        encodedContent = codec.encode(content)
+                        if self.compressionPolicy.worthwhile(len(content), len(encodedContent)):
+                            content = encodedContent
+                            codecName = codec.name
+                    pack = PackLocation(self.backupKeyBase, self.packNumber, offset, len(content))
+                    locationsByHash[pathSummary.hash] = (pack, codecName)
+                    contents.append (content)
+                    offset += len(content)
+                self.memberSummaries.append (FileSummary(pathSummary.relativePath, pathSummary.hash, 
+                                                         codec = codecName, pack = pack))
+            self.packKey = PackLocation(self.backupKeyBase, self.packNumber, 0, offset).packKey()
+            print "Writing %r (%d files, %d bytes) ..." % (self.packKey, len(self.members), offset)
+            self.backupMap[self.packKey] = "".join(contents)
+            
+        def doSynchronized(self):
+            for memberSummary in self.memberSummaries:
+                self.writtenFileSummaries.append (memberSummary)
+                self.writtenRecords.recordHashWritten (memberSummary.hash, 
+                                                       self.backupKeyBase + memberSummary.relativePath)
+            
+    class ChunkedBackupFileTask:
+        """Task to back up a file as content-defined chunks, only writing those chunks
+        not already written (to this backup or previous backups in the same group)"""
+        def __init__(self, backupMap, backupKeyBase, pathSummary, fileName, writtenRecords, 
+                     writtenFileSummaries, chunker, compressionPolicy = None):
+            self.backupMap = backupMap
+            self.backupKeyBase = backupKeyBase
+            self.pathSummary = pathSummary
+            self.fileName = fileName
+            self.writtenRecords = writtenRecords
+            self.writtenFileSummaries = writtenFileSummaries
+            self.chunker = chunker
+            self.compressionPolicy = compressionPolicy
+            
+        def __repr__(self):
+            return "<ChunkedBackupFileTask %r>" % self.fileName
+        
+        def doUnsynchronized(self):
+            print "Writing chunks of %r ..." % self.fileName
+            self.chunks = []
+            numChunksWritten = 0
+            codec = self.compressionPolicy is not None and self.compressionPolicy.codecForFile(self.fileName) or None
+            f = file(self.fileName, "rb")
+            try:
+                for chunk in self.chunker.chunks(f):
+                    chunkHash = sha1Digest(chunk)
+                    chunkKey = self.writtenRecords.chunkLocationWritten(chunkHash)
+                    if chunkKey is None:
+                        if codec is not None:
+                            encodedChunk = codec.encode(chunk)
+                            if self.compressionPolicy.worthwhile(len(chunk), len(encodedChunk)):
+                                chunk = encodedChunk
+                                chunkKey = ChunkKey(self.backupKeyBase, chunkHash, codec.name)
+                        if chunkKey is None:
+                            chunkKey = ChunkKey(self.backupKeyBase, chunkHash)
+                        self.backupMap[chunkKey.chunkKey()] = chunk
+                        self.writtenRecords.recordChunkWritten(chunkKey)
+                        numChunksWritten += 1
+                    self.chunks.append (chunkKey)
+            finally:
+                f.close()
+            print " wrote %d of %d chunks of %r" % (numChunksWritten, len(self.chunks), self.fileName)
+            
+        def doSynchronized(self):
+            relativePath = self.pathSummary.relativePath
+            self.writtenFileSummaries.append (FileSummary(relativePath, self.pathSummary.hash, self.chunks))
+            self.writtenRecords.recordHashWritten (self.pathSummary.hash, self.backupKeyBase + relativePath)
+            
+    def doBackup(self, directoryInfo, full = True, chunker = None, compressionPolicy = None, packPolicy = None, 
+                 writtenIndex = None):
         """Create a new backup of a source directory (full or incremental).
         Note: 'incremental' is based on comparing the hashes of file contents already marked as
         written to previous backups in the same backup group. It is not based on any comparison
         of files done on the source computer. If a given file contents has already been written, 
         then the relevant file written as a pointer to the previous file with the same contents
         (which may or may not be the same file in the same place on the source computer).
+        If a chunker (ContentDefinedChunker) is given, files of at least chunker.minSize bytes
+        are written as chunks, and only chunks not already written are written.
+        If a compressionPolicy (Codecs.CompressionPolicy) is given, file contents (or chunks)
+        are written compressed where that is worthwhile.
+        If a packPolicy (PackPolicy) is given, small files are written together in packs.
+        If a writtenIndex (WrittenIndex) is given, it is used to find out which file contents were written
+        by previous backups, and it is updated with what this backup writes.
         """
         dateTimeString = self.getDateTimeString()
         backupKeyBase = dateTimeString
-        backupFilesKeyBase = backupKeyBase + "/files"
         print "retrieving existing backup records ..."
         backupRecords = self.getBackupRecords()
         print "backup records = %r" % backupRecords
         currentBackupRecord = BackupRecord(full and "full" or "incremental", dateTimeString, completed = False)
         backupRecords.append(currentBackupRecord)
         backupRecordUpdater = BackupRecordUpdater (self, backupRecords, currentBackupRecord, 
-                                                   backupKeyBase, directoryInfo, recordTrigger = self.recordTrigger)
+                                                   backupKeyBase, directoryInfo, recordTrigger = self.recordTrigger, 
+                                                   writtenIndex = writtenIndex)
         backupRecordUpdater.initialRecord()
         writtenRecords = WrittenRecords()
         if not full:
@@ -673,21 +1353,65 @@ class IncrementalBackups:
                 full = True
                 print "No previous records, so backup will be FULL anyway"
             else:
-                writtenRecords.recordPreviousBackups (self.backupMap, backupRecords)
-        backupFileTasks = []
-        for pathSummary in directoryInfo.pathSummaries:
+                writtenRecords.recordPreviousBackups (self.backupMap, backupRecords, writtenIndex)
+        elif writtenIndex is not None:
+            writtenIndex.validate([currentBackupRecord])
+        backupFileTasks = self.generateBackupFileTasks (directoryInfo, backupKeyBase, writtenRecords, 
+                                                        backupRecordUpdater, chunker, compressionPolicy, packPolicy)
+        try:
+            taskRunner.runTaskStream (backupFileTasks, checkpointTask = backupRecordUpdater)
+        except TasksFailed:
+            # record what was written, so that a following incremental backup doesn't write it again
+            backupRecordUpdater.checkpoint()
+            raise
+        backupRecordUpdater.recordCompleted()
+        
+    def generateBackupFileTasks(self, directoryInfo, backupKeyBase, writtenRecords, backupRecordUpdater, 
+                                chunker, compressionPolicy, packPolicy):
+        """Yield the tasks to back up file contents not already written, as the source directory is summarized"""
+        backupFilesKeyBase = backupKeyBase + "/files"
+        packMembers = []
+        packMembersSize = 0
+        packNumber = 0
+        for pathSummary in directoryInfo.iterPathSummaries():
             if not pathSummary.isDir:
                 fileName = pathSummary.fullPath(directoryInfo.path)
                 if not writtenRecords.isWritten(pathSummary.hash):
-                    backupFileTask = IncrementalBackups.BackupFileTask(self.backupMap, backupFilesKeyBase, 
-                                                                       pathSummary, fileName, writtenRecords, 
-                                                                       backupRecordUpdater.writtenFileSummaries)
-                    backupFileTasks.append (backupFileTask)
+                    fileSize = os.path.getsize(fileName)
+                    if packPolicy is not None and fileSize <= packPolicy.maxMemberSize:
+                        packMembers.append ((pathSummary, fileName))
+                        packMembersSize += fileSize
+                        if packMembersSize >= packPolicy.packSize:
+                            yield self.createPackBackupTask(backupKeyBase, packNumber, packMembers, writtenRecords, 
+                                                            backupRecordUpdater, compressionPolicy)
+                            packNumber += 1
+                            packMembers = []
+                            packMembersSize = 0
+                        continue
+                    if chunker is not None and fileSize >= chunker.minSize:
+                        backupFileTask = IncrementalBackups.ChunkedBackupFileTask(self.backupMap, backupKeyBase, 
+                                                                                  pathSummary, fileName, writtenRecords, 
+                                                                                  backupRecordUpdater.writtenFileSummaries, 
+                                                                                  chunker, compressionPolicy)
+                    else:
+                        backupFileTask = IncrementalBackups.BackupFileTask(self.backupMap, backupFilesKeyBase, 
+                                                                           pathSummary, fileName, writtenRecords, 
+                                                                           backupRecordUpdater.writtenFileSummaries, 
+                                                                           compressionPolicy)
+                    yield backupFileTask
                 else:
                     print "Content of %r already written to %r" % (pathSummary, 
                                                                    writtenRecords.locationWritten (pathSummary.hash))
-        taskRunner.runTasks (backupFileTasks, checkpointTask = backupRecordUpdater)
-        backupRecordUpdater.recordCompleted()
+        if len(packMembers) > 0:
+            yield self.createPackBackupTask(backupKeyBase, packNumber, packMembers, writtenRecords, 
+                                            backupRecordUpdater, compressionPolicy)
+        
+    def createPackBackupTask(self, backupKeyBase, packNumber, packMembers, writtenRecords, 
+                             backupRecordUpdater, compressionPolicy):
+        """Create the task to write a numbered pack"""
+        return IncrementalBackups.PackBackupTask(self.backupMap, backupKeyBase, packNumber, packMembers, 
+                                                 writtenRecords, backupRecordUpdater.writtenFileSummaries, 
+                                                 compressionPolicy)
         
     def doFullBackup(self, directoryInfo):
         """Do a full backup of a source directory"""
@@ -720,7 +1444,7 @@ class IncrementalBackups:
         dateTimeString = backupRecord.datetime
         backupKeyBase = dateTimeString
         print "getPathSummaryDataList for %r ..." % backupRecord
-        pathSummariesData = yaml.safe_load(self.backupMap[backupKeyBase + "/pathList"])
+        pathSummariesData = getPathSummariesData(self.backupMap, backupKeyBase)
         return pathSummariesData
     
     def getWrittenFileSummaryDataList(self, backupRecord):
@@ -729,9 +1453,7 @@ class IncrementalBackups:
         dateTimeString = backupRecord.datetime
         backupKeyBase = dateTimeString
         print "getWrittenFileSummaryDataList for %r ..." % backupRecord
-        writtenPathListKey = backupKeyBase + "/writtenPathList"
-        writtenFileSummariesData = yaml.safe_load(self.backupMap[backupKeyBase + "/writtenPathList"])
-        return writtenFileSummariesData
+        return getWrittenFileSummariesData(self.backupMap, backupKeyBase)
         
     def getHashContentKeyMap(self, restoreRecords, writtenFileSummaryLists):
         """Construct a map from hash keys to the backup keys to which those file contents
@@ -740,29 +1462,70 @@ class IncrementalBackups:
         for restoreRecord, writtenFileSummaryList in zip(restoreRecords, writtenFileSummaryLists):
             for writtenFileSummary in writtenFileSummaryList:
                 hashContentKeyMap[writtenFileSummary.hash] = ContentKey(restoreRecord.datetime, 
-                                                                        writtenFileSummary.relativePath)
+                                                                        writtenFileSummary.relativePath, 
+                                                                        writtenFileSummary.chunks, 
+                                                                        writtenFileSummary.codec, 
+                                                                        writtenFileSummary.pack)
         return hashContentKeyMap
     
     class RestoreFileTask:
-        def __init__(self, backupMap, contentKey, fullPath, updateVerificationRecords, verificationRecords, overwrite):
+        def __init__(self, backupMap, contentKey, fullPath, updateVerificationRecords, verificationRecords, overwrite, 
+                     duplicatePaths = [], duplicateMethod = "reflink"):
+            """Task to restore a file, and then any other files with the same content (duplicatePaths), 
+            which are made from the restored file (see duplicateFile) instead of being downloaded again"""
             self.backupMap = backupMap
             self.contentKey = contentKey
             self.fullPath = fullPath
             self.updateVerificationRecords = updateVerificationRecords
             self.verificationRecords = verificationRecords
             self.overwrite = overwrite
+            self.duplicatePaths = duplicatePaths
+            self.duplicateMethod = duplicateMethod
             
-        def getThreadLocals(self):
-            return {"backupMap": self.backupMap.clone()}
+        def __repr__(self):
+            return "<RestoreFileTask %r>" % self.fullPath
         
         def doUnsynchronized(self):
-            content = self.backupMap[self.contentKey.fileKey()]
             if os.path.exists(self.fullPath) and self.overwrite:
                 os.remove (self.fullPath)
-            writeFileBytes(self.fullPath, content)
+            if self.contentKey.chunks is not None:
+                self.restoreChunks()
+            elif self.contentKey.codec is not None:
+                self.restoreEncoded()
+            else:
+                self.backupMap.getToFile(self.contentKey.fileKey(), self.fullPath)
             if self.updateVerificationRecords:
-                self.contentHash = sha1Digest(content)
+                self.contentHash = fileSha1Digest(self.fullPath)
             print "Restored FILE %r" % self.fullPath
+            restoreDuplicates(self.fullPath, self.duplicatePaths, self.duplicateMethod, self.overwrite)
+            
+        def restoreChunks(self):
+            """Restore a file written as chunks, one chunk at a time"""
+            f = file(self.fullPath, "wb")
+            try:
+                for chunk in self.contentKey.chunks:
+                    f.write(chunk.getContent(self.backupMap))
+            finally:
+                f.close()
+                
+        def restoreEncoded(self):
+            """Restore a file written compressed, by downloading to a temporary file and then decoding"""
+            codec = getCodec(self.contentKey.codec)
+            fd, encodedFileName = tempfile.mkstemp(prefix = ".keevalbak-", dir = os.path.dirname(self.fullPath))
+            os.close(fd)
+            try:
+                self.backupMap.getToFile(self.contentKey.fileKey(), encodedFileName)
+                encodedFile = file(encodedFileName, "rb")
+                try:
+                    f = file(self.fullPath, "wb")
+                    try:
+                        codec.decodeStream(encodedFile, f)
+                    finally:
+                        f.close()
+                finally:
+                    encodedFile.close()
+            finally:
+                os.remove(encodedFileName)
                     
         def doSynchronized(self):
             if self.updateVerificationRecords:
@@ -770,13 +1533,72 @@ class IncrementalBackups:
                                                        self.contentKey.filePath, self.contentHash)
                 print "Mark verified FILE %r" % self.fullPath
     
+    class RestorePackTask:
+        """Task to restore all the files with contents in one pack, reading the pack with one request
+        (where files with the same content as a pack member are made from the restored member)"""
+        def __init__(self, backupMap, packKey, members, updateVerificationRecords, verificationRecords, overwrite, 
+                     duplicatePaths = {}, duplicateMethod = "reflink"):
+            self.backupMap = backupMap
+            self.packKey = packKey
+            self.members = members # list of (contentKey, fullPath)
+            self.updateVerificationRecords = updateVerificationRecords
+            self.verificationRecords = verificationRecords
+            self.overwrite = overwrite
+            self.duplicatePaths = duplicatePaths # map from member fullPath to list of duplicate paths
+            self.duplicateMethod = duplicateMethod
+            
+        def __repr__(self):
+            return "<RestorePackTask %r (%d files)>" % (self.packKey, len(self.members))
+        
+        def doUnsynchronized(self):
+            start = min(contentKey.pack.offset for contentKey, fullPath in self.members)
+            end = max(contentKey.pack.offset + contentKey.pack.length for contentKey, fullPath in self.members)
+            packContents = self.backupMap.getRange(self.packKey, start, end)
+            self.contentHashes = []
+            for contentKey, fullPath in self.members:
+                offset = contentKey.pack.offset - start
+                content = packContents[offset:offset + contentKey.pack.length]
+                if contentKey.codec is not None:
+                    content = getCodec(contentKey.codec).decode(content)
+                if os.path.exists(fullPath) and self.overwrite:
+                    os.remove (fullPath)
+                writeFileBytes(fullPath, content)
+                if self.updateVerificationRecords:
+                    self.contentHashes.append (sha1Digest(content))
+                print "Restored FILE %r" % fullPath
+                restoreDuplicates(fullPath, self.duplicatePaths.get(fullPath, []), self.duplicateMethod, self.overwrite)
+                
+        def doSynchronized(self):
+            if self.updateVerificationRecords:
+                for (contentKey, fullPath), contentHash in zip(self.members, self.contentHashes):
+                    self.verificationRecords.markVerified (contentKey.datetime, contentKey.filePath, contentHash)
+                    print "Mark verified FILE %r" % fullPath
+    
     def restoreDirectory(self, restoreDir, pathSummaryList, hashContentKeyMap, overwrite, 
-                         updateVerificationRecords = False):
-        """Restore a directory using path summaries and hash content key map, with optional overwrite"""
+                         updateVerificationRecords = False, duplicateMethod = "reflink"):
+        """Restore a directory using path summaries and hash content key map, with optional overwrite.
+        Each distinct content is downloaded once, and other files with the same content are
+        made from the first one restored, according to duplicateMethod (see duplicateFile)."""
         print "Restoring directory %r ..." % restoreDir
         if updateVerificationRecords:
             verificationRecords = HashVerificationRecords(self.backupMap)
-        restoreFileTasks = []
+        else:
+            verificationRecords = None
+        restoreFileTasks = self.generateRestoreFileTasks (restoreDir, pathSummaryList, hashContentKeyMap, overwrite, 
+                                                          updateVerificationRecords, verificationRecords, 
+                                                          duplicateMethod)
+        taskRunner.runTaskStream (restoreFileTasks)
+        if updateVerificationRecords:
+            verificationRecords.updateRecords()
+            
+    def generateRestoreFileTasks(self, restoreDir, pathSummaryList, hashContentKeyMap, overwrite, 
+                                 updateVerificationRecords, verificationRecords, duplicateMethod = "reflink"):
+        """Create restored directories, and then yield tasks to restore files, in the order of the path summaries 
+        (except that files in packs are restored after all other files, one task per pack), where there
+        is one task for each distinct content, which also makes all the other files with that content"""
+        filePathSummaries = []
+        duplicatePaths = {}
+        firstPathsOfHashes = {}
         for pathSummary in pathSummaryList:
             fullPath = pathSummary.fullPath (restoreDir)
             if pathSummary.isDir:
@@ -784,18 +1606,32 @@ class IncrementalBackups:
                     os.makedirs(fullPath)
                 print "Restored DIR  %r" % fullPath
             elif pathSummary.isFile:
-                if not pathSummary.hash in hashContentKeyMap:
-                    print "WARNING: No written content found for %r (hash %s)" % (pathSummary.relativePath, 
-                                                                                  pathSummary.hash)
-                contentKey = hashContentKeyMap[pathSummary.hash]
-                restoreFileTasks.append (IncrementalBackups.RestoreFileTask (self.backupMap, contentKey, 
-                                                                             fullPath, updateVerificationRecords, 
-                                                                             verificationRecords, overwrite))
+                if pathSummary.hash in firstPathsOfHashes:
+                    duplicatePaths[firstPathsOfHashes[pathSummary.hash]].append (fullPath)
+                else:
+                    firstPathsOfHashes[pathSummary.hash] = fullPath
+                    duplicatePaths[fullPath] = []
+                    filePathSummaries.append (pathSummary)
             else:
                 print "WARNING: Unknown path type %r" % pathSummary
-        taskRunner.runTasks (restoreFileTasks)
-        if updateVerificationRecords:
-            verificationRecords.updateRecords()
+        packMembers = {}
+        for pathSummary in filePathSummaries:
+            fullPath = pathSummary.fullPath (restoreDir)
+            if not pathSummary.hash in hashContentKeyMap:
+                # (e.g. if the backup was interrupted before the content was written)
+                print "WARNING: No written content found for %r (hash %s)" % (pathSummary.relativePath, 
+                                                                              pathSummary.hash)
+                continue
+            contentKey = hashContentKeyMap[pathSummary.hash]
+            if contentKey.pack is not None:
+                packMembers.setdefault(contentKey.pack.packKey(), []).append ((contentKey, fullPath))
+            else:
+                yield IncrementalBackups.RestoreFileTask (self.backupMap, contentKey, fullPath, 
+                                                          updateVerificationRecords, verificationRecords, overwrite, 
+                                                          duplicatePaths[fullPath], duplicateMethod)
+        for packKey, members in sorted(packMembers.iteritems()):
+            yield IncrementalBackups.RestorePackTask (self.backupMap, packKey, members, updateVerificationRecords, 
+                                                      verificationRecords, overwrite, duplicatePaths, duplicateMethod)
             
     def getRestoreDetails(self, dateTimeString):
         backupRecords = self.getBackupRecords()
@@ -833,7 +1669,7 @@ class IncrementalBackups:
                 contentKey = hashContentKeyMap[pathSummary.hash]
                 # We could compare pathSummary.hash and fileHash, 
                 # but the verified fileHash is what matters (to compare to local file)
-                fileHash = verificationRecords.getWrittenFileHash(contentKey.datetime, contentKey.filePath)
+                fileHash = verificationRecords.getWrittenFileHash(contentKey)
                 restoredDirHash.addFileSummary(pathSummary.relativePath, fileHash)
                 print " FILE %r" % pathSummary.relativePath
             else:
@@ -841,7 +1677,7 @@ class IncrementalBackups:
         verificationRecords.updateRecords()
         return restoredDirHash
         
-    def incrementalVerify(self, sourceDir):
+    def incrementalVerify(self, sourceDir, hashCache = None):
         """Incrementally verify a directory using path summaries and hash content key map, with optional overwrite"""
         print "Incrementally verifying against directory %r ..." % sourceDir
         restoredDirHash = self.getRestoredDirHash()
@@ -849,16 +1685,18 @@ class IncrementalBackups:
         restoredDirHash.printIndented()
         print ""
         print "LOCAL DIR HASH for %r" % sourceDir
-        localDirHash = DirHash(sourceDir, None, sourceDir)
+        localDirHash = DirHash(sourceDir, None, sourceDir, hashCache)
         localDirHash.printIndented()
         errorDiff = CompareDirectories.ErrorDiff()
         localDirHash.compareToOtherDirHash (restoredDirHash, 0, CompareDirectories.printLog, errorDiff)
         errorDiff.logAndCheck (localDirHash.description, restoredDirHash.description)
             
     def restore(self, restoreDir, dateTimeString = None, 
-                overwrite = False, updateVerificationRecords = False, allowIncomplete = False):
+                overwrite = False, updateVerificationRecords = False, allowIncomplete = False, 
+                duplicateMethod = "reflink"):
         """Restore the specified (or otherwise the most recent) backup to a 
-        destination directory (with optional overwrite)"""
+        destination directory (with optional overwrite), where files with the same content
+        are made from the first one restored according to duplicateMethod (see duplicateFile)"""
         print u"Restoring to %s ..." % restoreDir
         if not os.path.exists(restoreDir):
             os.makedirs(restoreDir)
@@ -870,7 +1708,7 @@ class IncrementalBackups:
         if not allowIncomplete and not backupToRestore.completed:
             raise "Backup dated %s is not complete and allowIncomplete is set to false" % backupToRestore.datetime
         self.restoreDirectory (restoreDir, pathSummaryListToRestore, hashContentKeyMap, 
-                               overwrite, updateVerificationRecords)
+                               overwrite, updateVerificationRecords, duplicateMethod)
         print "Restored data to %r" % restoreDir
         
 def listBackups(backupMap):
@@ -882,10 +1720,26 @@ def pruneBackups(backupMap, keep = 1, dryRun = True):
     IncrementalBackups(backupMap).pruneBackups(keep = keep, dryRun = dryRun)
 
 def doBackup(sourceDirectory, backupMap, testRestoreDir = None, full = False, verify = False, 
-             doTheBackup = True, verifyIncrementally = False, recordTrigger = 10000000):
+             doTheBackup = True, verifyIncrementally = False, recordTrigger = 10000000, 
+             hashCacheFile = None, numHashWorkers = None, hashWorkerType = "thread", chunked = False, 
+             compression = None, packSmallFiles = False, writtenIndexFile = None, maxThreads = None, 
+             numGreenlets = None):
     """Do a backup from source directory to backup map, with options 'full' (or incremental)
     and 'verify' (in which case a test restore is done to the test restore directory).
     Also, if 'doTheBackup' is set to false, only do the test restore and verify.
+    If 'hashCacheFile' is given, hashes of source files are cached there between runs, so
+    that unchanged files do not have to be read again.
+    If 'numHashWorkers' is given, source files are hashed in parallel (see DirectoryInfo).
+    If 'chunked' is set, large files are written as content-defined chunks (see IncrementalBackups.doBackup).
+    If 'compression' is the name of a codec (e.g. "zlib"), file contents are written compressed where worthwhile.
+    If 'packSmallFiles' is set, small files are written together in packs (see PackPolicy).
+    If 'writtenIndexFile' is given, a local index of file contents written to the backup map is kept
+    there (see WrittenIndex), so that incremental backups don't have to read all previous backup records.
+    If 'maxThreads' is given, the number of files transferred at once is adapted to the observed throughput,
+    latency and errors, up to maxThreads (see useAdaptiveTaskRunner).
+    If 'numGreenlets' is given, files are transferred by that many greenlets instead of by threads
+    (see useGreenletTaskRunner), which requires GreenletTaskRunner.patchForGreenlets to have been called
+    at the start of the program (as done by BackupExample and Benchmark).
     """
     startTime = datetime.datetime.now()
     print ""
@@ -894,10 +1748,21 @@ def doBackup(sourceDirectory, backupMap, testRestoreDir = None, full = False, ve
     if verify and testRestoreDir == None:
         raise "Must supply testRestoreDir argument if verify option is chosen"
     print "Backing up %r ..." % sourceDirectory
+    if maxThreads is not None:
+        useAdaptiveTaskRunner(maxThreads = maxThreads)
+    if numGreenlets is not None:
+        useGreenletTaskRunner(numGreenlets = numGreenlets)
     backups = IncrementalBackups(backupMap, recordTrigger)
-    srcDirInfo = DirectoryInfo(sourceDirectory)
+    hashCache = hashCacheFile and HashCache(hashCacheFile) or None
+    srcDirInfo = DirectoryInfo(sourceDirectory, hashCache, numHashWorkers = numHashWorkers, 
+                               hashWorkerType = hashWorkerType, lazy = True)
     if doTheBackup:
-        backups.doBackup (srcDirInfo, full = full)
+        backups.doBackup (srcDirInfo, full = full, chunker = chunked and ContentDefinedChunker() or None, 
+                          compressionPolicy = compression and CompressionPolicy(compression) or None, 
+                          packPolicy = packSmallFiles and PackPolicy() or None, 
+                          writtenIndex = writtenIndexFile and WrittenIndex(writtenIndexFile) or None)
+        if hashCache is not None:
+            hashCache.save()
         backupFinishedTime = datetime.datetime.now()
         backupTimeTaken = backupFinishedTime - startTime
         backupFinishedMessage = "Backup finished %s (started %s, took %s)" % (backupFinishedTime, 
@@ -910,7 +1775,7 @@ def doBackup(sourceDirectory, backupMap, testRestoreDir = None, full = False, ve
         print "Verifying ..."
         if verifyIncrementally:
             print "   incrementally ..."
-            backups.incrementalVerify (sourceDirectory)
+            backups.incrementalVerify (sourceDirectory, hashCache)
         else:
             print "   fully ..."
             print u"   removing existing files from %s ..." % testRestoreDir
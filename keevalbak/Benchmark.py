@@ -0,0 +1,370 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Benchmarks of backups, verifies and prunes, from generated source trees to a simulated 
+remote object store (see SimulatedBucketMap), reporting the rate at which files and bytes were 
+processed, the numbers of requests made, and the peak memory use of the process.
+
+For example, to benchmark all the tree profiles with 50ms request latency and a 10MB/s link:
+    
+    python Benchmark.py --latency 0.05 --bandwidth 10
+"""
+
+import sys
+
+# Transferring files with greenlets (--num-greenlets) requires the standard library to be 
+# patched before anything using sockets or threads is imported
+if __name__ == '__main__' and any(arg.startswith("--num-greenlets") for arg in sys.argv[1:]):
+    from GreenletTaskRunner import patchForGreenlets
+    patchForGreenlets()
+
+import argparse
+import filecmp
+import os
+import random
+import re
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+import BackupOperations
+from ThreadedTaskRunner import TasksFailed
+from localbucketmap import DirectoryBucketMap, InMemoryBucketMap
+from simulatedbucketmap import SimulatedBucketMap, StoreSimulation
+from cachingbucketmap import CachingBucketMap, DiskCache
+
+def writeFile(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    f = file(path, "wb")
+    try:
+        f.write(content)
+    finally:
+        f.close()
+        
+def randomContent(rand, size):
+    """Incompressible content of a given size"""
+    return "".join(chr(rand.getrandbits(8)) for i in xrange(size))
+
+def textContent(rand, size):
+    """Compressible (text-like) content of a given size"""
+    words = ["backup", "bucket", "key", "value", "file", "directory", "hash", "content", "\n"]
+    parts = []
+    length = 0
+    while length < size:
+        word = rand.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    return " ".join(parts)[:size]
+
+def generateTinyFiles(path, rand, scale):
+    """Many small files spread over a few directories"""
+    for i in xrange(int(2000 * scale)):
+        writeFile(os.path.join(path, "dir%02d" % (i % 40), "file%05d.txt" % i), 
+                  textContent(rand, rand.randint(10, 2000)))
+        
+def generateHugeFiles(path, rand, scale):
+    """A few large files"""
+    for i in xrange(3):
+        writeFile(os.path.join(path, "huge%d.bin" % i), 
+                  os.urandom(int(16 * 1024 * 1024 * scale)))
+        
+def generateDeepNesting(path, rand, scale):
+    """Directories nested many levels deep, with a few files at each level"""
+    for branch in xrange(max(1, int(4 * scale))):
+        directory = os.path.join(path, "branch%d" % branch)
+        for depth in xrange(60):
+            directory = os.path.join(directory, "level%02d" % depth)
+            for i in xrange(3):
+                writeFile(os.path.join(directory, "file%d.txt" % i), textContent(rand, rand.randint(100, 5000)))
+                
+def generateDuplicates(path, rand, scale):
+    """Many files, with only a few different contents between them"""
+    contents = [randomContent(rand, rand.randint(1000, 200000)) for i in xrange(10)]
+    for i in xrange(int(1000 * scale)):
+        writeFile(os.path.join(path, "dir%02d" % (i % 20), "copy%05d.dat" % i), rand.choice(contents))
+        
+# Generators of source trees with different shapes, by name
+TreeProfiles = {"tinyFiles": generateTinyFiles, 
+                "hugeFiles": generateHugeFiles, 
+                "deepNesting": generateDeepNesting, 
+                "duplicates": generateDuplicates}
+
+def generateTree(path, profile, scale = 1.0, seed = 0):
+    """Generate a source tree in a (new) directory, according to the named profile (see TreeProfiles), 
+    where scale multiplies the number or size of files"""
+    os.makedirs(path)
+    TreeProfiles[profile](path, random.Random(seed), scale)
+    
+def treeSize(path):
+    """Return (number of files, total bytes) in a directory tree"""
+    numFiles = 0
+    numBytes = 0
+    for dirPath, dirNames, fileNames in os.walk(path):
+        for fileName in fileNames:
+            numFiles += 1
+            numBytes += os.path.getsize(os.path.join(dirPath, fileName))
+    return (numFiles, numBytes)
+
+def modifyTree(path, fraction = 0.05, seed = 1):
+    """Change some of the files in a source tree (before an incremental backup), by changing
+    the contents of about 'fraction' of them, and adding a new file"""
+    rand = random.Random(seed)
+    for dirPath, dirNames, fileNames in os.walk(path):
+        for fileName in fileNames:
+            if rand.random() < fraction:
+                filePath = os.path.join(dirPath, fileName)
+                writeFile(filePath, textContent(rand, rand.randint(10, 5000)))
+    writeFile(os.path.join(path, "new-file.txt"), textContent(rand, 1000))
+    
+def checkRestoredFiles(restoreDir, sourceDir):
+    """Check that every file restored (e.g. from an incomplete backup) is the same as the source file, 
+    returning the number of files restored"""
+    numFiles = 0
+    for dirPath, dirNames, fileNames in os.walk(restoreDir):
+        for fileName in fileNames:
+            restoredPath = os.path.join(dirPath, fileName)
+            sourcePath = os.path.join(sourceDir, os.path.relpath(restoredPath, restoreDir))
+            if not filecmp.cmp(restoredPath, sourcePath, shallow = False):
+                raise Exception("Restored file %r is not the same as %r" % (restoredPath, sourcePath))
+            numFiles += 1
+    print "%d restored files are the same as the source files" % numFiles
+    return numFiles
+
+# Keys of values holding file contents (as opposed to backup records)
+ContentKeyRegex = re.compile(r"^[^/]+/(files|chunks|packs)/")
+
+class ContentWriteFailures(object):
+    """Which writes fail in a StoreSimulation (see failWrite): every second write of file contents 
+    (but no writes of backup records), so that a backup fails part way through, like an interrupted backup"""
+    def __init__(self):
+        self.numContentWrites = 0
+        self.lock = threading.Lock()
+        
+    def __call__(self, key):
+        if not ContentKeyRegex.match(key):
+            return False
+        with self.lock:
+            self.numContentWrites += 1
+            return self.numContentWrites % 2 == 0
+        
+def peakMemoryUse():
+    """Peak resident memory use of this process in MB (ru_maxrss is in KB on Linux, but bytes on Mac OS)"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return maxrss / (1024.0 * 1024.0)
+    return maxrss / 1024.0
+
+def waitForNextSecond():
+    """Wait until the start of the next second (dated backups are named to the nearest second, 
+    so two backups must not be started in the same second). A small margin is added 
+    in case the clock is adjusted slightly backwards just after the wait."""
+    now = time.time()
+    time.sleep(int(now) + 1 - now + 0.05)
+    
+class QuietOutput(object):
+    """Context manager discarding everything printed (by any thread) while it is active"""
+    def __init__(self, quiet = True):
+        self.quiet = quiet
+    
+    def __enter__(self):
+        if self.quiet:
+            self.stdout = sys.stdout
+            sys.stdout = file(os.devnull, "w")
+    
+    def __exit__(self, excType, excValue, traceback):
+        if self.quiet:
+            sys.stdout.close()
+            sys.stdout = self.stdout
+            
+class PhaseResult(object):
+    """Measurements of one phase (e.g. a full backup) of a benchmark"""
+    def __init__(self, name, seconds, numFiles, numBytes, counts, peakMemory, error = None):
+        self.name = name
+        self.seconds = seconds
+        self.numFiles = numFiles
+        self.numBytes = numBytes
+        self.counts = counts
+        self.peakMemory = peakMemory
+        self.error = error
+    
+    def numRequests(self):
+        return sum(self.counts.get(requestType, 0) for requestType in RequestTypes)
+    
+    def report(self):
+        seconds = max(self.seconds, 0.001)
+        requestCounts = " ".join("%s=%d" % (requestType, self.counts.get(requestType, 0)) 
+                                 for requestType in RequestTypes)
+        line = ("%-18s %8.2fs %9.1f files/s %8.2f MB/s  %s throttled=%d sent=%.1fMB received=%.1fMB  peak RSS %.1fMB" % 
+                (self.name, self.seconds, self.numFiles / seconds, self.numBytes / seconds / (1024 * 1024), 
+                 requestCounts, self.counts.get("throttled", 0), 
+                 self.counts.get("bytesSent", 0) / (1024.0 * 1024), 
+                 self.counts.get("bytesReceived", 0) / (1024.0 * 1024), self.peakMemory))
+        if self.error is not None:
+            line += "  FAILED: %s" % self.error
+        return line
+    
+# Types of request counted by StoreSimulation
+RequestTypes = ["GET", "PUT", "HEAD", "DELETE", "LIST"]
+
+class Benchmark(object):
+    """A sequence of timed phases (full backup, incremental backup, incremental verify, full verify
+    and prune, and then a backup which is interrupted, and a restore of that incomplete backup)
+    for one source tree, backing up to a SimulatedBucketMap."""
+    
+    def __init__(self, workDir, profile, scale = 1.0, simulation = None, backing = "memory", 
+                 manifestCache = False, quiet = True, **backupOptions):
+        self.workDir = workDir
+        self.profile = profile
+        self.scale = scale
+        self.simulation = simulation or StoreSimulation()
+        self.quiet = quiet
+        self.backupOptions = backupOptions
+        self.sourceDir = os.path.join(workDir, "source")
+        self.testRestoreDir = os.path.join(workDir, "restore")
+        if backing == "directory":
+            backingMap = DirectoryBucketMap(os.path.join(workDir, "backups"))
+        else:
+            backingMap = InMemoryBucketMap()
+        self.backupMap = SimulatedBucketMap(backingMap, self.simulation)
+        if manifestCache:
+            self.backupMap = CachingBucketMap(self.backupMap, DiskCache(os.path.join(workDir, "manifestCache")))
+        self.results = []
+    
+    def runPhase(self, name, function, numFiles, numBytes, newBackup = False):
+        """Run and time one phase, recording the results (and returning False if it failed)"""
+        if newBackup:
+            waitForNextSecond()
+        self.simulation.resetCounts()
+        error = None
+        startTime = time.time()
+        try:
+            with QuietOutput(self.quiet):
+                function()
+        except Exception, e:
+            error = e
+        seconds = time.time() - startTime
+        result = PhaseResult(name, seconds, numFiles, numBytes, self.simulation.counts(), 
+                             peakMemoryUse(), error = error)
+        self.results.append(result)
+        print result.report()
+        return error is None
+    
+    def backup(self, full):
+        BackupOperations.doBackup(self.sourceDir, self.backupMap, full = full, **self.backupOptions)
+    
+    def verify(self, incrementally):
+        BackupOperations.doBackup(self.sourceDir, self.backupMap, self.testRestoreDir, doTheBackup = False, 
+                                  verify = True, verifyIncrementally = incrementally, **self.backupOptions)
+    
+    def prune(self):
+        BackupOperations.pruneBackups(self.backupMap, keep = 1, dryRun = False)
+    
+    def interruptedBackup(self):
+        """A full backup where some writes of file contents fail (so that it is never completed, 
+        unless there is only one file contents to write)"""
+        self.simulation.failWrite = ContentWriteFailures()
+        try:
+            self.backup(full = True)
+        except TasksFailed:
+            print "Backup interrupted (as intended)"
+        finally:
+            self.simulation.failWrite = None
+            
+    def restoreIncomplete(self):
+        """Restore the most recent (possibly incomplete) backup, and check what was restored"""
+        shutil.rmtree(self.testRestoreDir)
+        backups = BackupOperations.IncrementalBackups(self.backupMap)
+        backups.restore(self.testRestoreDir, allowIncomplete = True)
+        checkRestoredFiles(self.testRestoreDir, self.sourceDir)
+    
+    def run(self):
+        print "Generating %r tree (scale %s) in %r ..." % (self.profile, self.scale, self.sourceDir)
+        generateTree(self.sourceDir, self.profile, self.scale)
+        os.makedirs(self.testRestoreDir)
+        numFiles, numBytes = treeSize(self.sourceDir)
+        print "  %d files, %.1f MB" % (numFiles, numBytes / (1024.0 * 1024))
+        if not self.runPhase("full backup", lambda: self.backup(full = True), numFiles, numBytes, 
+                             newBackup = True):
+            return self.results
+        modifyTree(self.sourceDir)
+        numFiles, numBytes = treeSize(self.sourceDir)
+        phases = [("incremental backup", lambda: self.backup(full = False), True), 
+                  ("incremental verify", lambda: self.verify(incrementally = True), False), 
+                  ("full verify", lambda: self.verify(incrementally = False), False), 
+                  ("second full backup", lambda: self.backup(full = True), True), 
+                  ("prune", self.prune, False), 
+                  ("interrupted backup", self.interruptedBackup, True), 
+                  ("incomplete restore", self.restoreIncomplete, False)]
+        for name, function, newBackup in phases:
+            if not self.runPhase(name, function, numFiles, numBytes, newBackup = newBackup):
+                break
+        return self.results
+    
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark backups to a simulated remote object store")
+    parser.add_argument("--profile", action = "append", choices = sorted(TreeProfiles.keys()), 
+                        help = "source tree profile (may be repeated, default all)")
+    parser.add_argument("--scale", type = float, default = 1.0, help = "multiplier of the number or size of files")
+    parser.add_argument("--latency", type = float, default = 0.05, help = "seconds per request")
+    parser.add_argument("--latency-jitter", type = float, default = 0.0, help = "maximum random extra seconds per request")
+    parser.add_argument("--bandwidth", type = float, default = None, help = "shared bandwidth in MB/s (default unlimited)")
+    parser.add_argument("--throttle-rate", type = float, default = 0.0, help = "probability of a request being throttled")
+    parser.add_argument("--max-request-rate", type = int, default = None, help = "requests per second before throttling")
+    parser.add_argument("--client-retries", type = int, default = 6, help = "retries of each throttled request")
+    parser.add_argument("--consistency-delay", type = float, default = 0.0, 
+                        help = "seconds before a written value becomes visible")
+    parser.add_argument("--backing", choices = ["memory", "directory"], default = "memory", 
+                        help = "where the simulated store keeps values")
+    parser.add_argument("--manifest-cache", action = "store_true", help = "cache manifests on local disk")
+    parser.add_argument("--max-threads", type = int, default = None, help = "adapt the number of threads up to this")
+    parser.add_argument("--num-greenlets", type = int, default = None, help = "transfer files with greenlets")
+    parser.add_argument("--chunked", action = "store_true", help = "write large files as chunks")
+    parser.add_argument("--compression", default = None, help = "codec for compressing file contents")
+    parser.add_argument("--pack-small-files", action = "store_true", help = "write small files in packs")
+    parser.add_argument("--work-dir", default = None, help = "directory for source trees etc. (default a temporary directory)")
+    parser.add_argument("--verbose", action = "store_true", help = "show the output of each phase")
+    args = parser.parse_args()
+    
+    workDir = args.work_dir or tempfile.mkdtemp(prefix = "keevalbak-benchmark-")
+    try:
+        for profile in args.profile or sorted(TreeProfiles.keys()):
+            simulation = StoreSimulation(latency = args.latency, latencyJitter = args.latency_jitter, 
+                                         bandwidth = args.bandwidth and args.bandwidth * 1024 * 1024, 
+                                         throttleRate = args.throttle_rate, maxRequestRate = args.max_request_rate, 
+                                         clientRetries = args.client_retries, 
+                                         consistencyDelay = args.consistency_delay)
+            benchmark = Benchmark(os.path.join(workDir, profile), profile, scale = args.scale, 
+                                  simulation = simulation, backing = args.backing, 
+                                  manifestCache = args.manifest_cache, quiet = not args.verbose, 
+                                  maxThreads = args.max_threads, numGreenlets = args.num_greenlets, 
+                                  chunked = args.chunked, compression = args.compression, 
+                                  packSmallFiles = args.pack_small_files)
+            benchmark.run()
+            print ""
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(workDir)
+            
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import zlib
+import bz2
+
+# lzma is built in from Python 3.3, otherwise the "backports.lzma" package may be installed
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Size of blocks in which data is read when encoding or decoding
+CodecBlockSize = 1024 * 1024
+
+class UnknownCodec(Exception):
+    def __init__(self, name):
+        Exception.__init__(self, "Unknown (or unavailable) codec %r" % name)
+        self.name = name
+
+class Decompressor(object):
+    """Wrapper giving the same decompress/flush methods to all decompressor objects"""
+    def __init__(self, decompressor):
+        self.decompressor = decompressor
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        if hasattr(self.decompressor, "flush"):
+            return self.decompressor.flush()
+        return ""
+
+class Codec(object):
+    """A named compression format, where compressors and decompressors work incrementally on blocks of data"""
+    def __init__(self, name, compressorFactory, decompressorFactory):
+        self.name = name
+        self.compressorFactory = compressorFactory
+        self.decompressorFactory = decompressorFactory
+
+    def compressor(self):
+        return self.compressorFactory()
+
+    def decompressor(self):
+        return Decompressor(self.decompressorFactory())
+
+    def encode(self, data):
+        compressor = self.compressor()
+        return compressor.compress(data) + compressor.flush()
+
+    def decode(self, data):
+        decompressor = self.decompressor()
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def encodeStream(self, inStream, outStream):
+        """Write encoded contents of one file-like object to another, returning the encoded size"""
+        return copyTransformed(inStream, outStream, self.compressor())
+
+    def decodeStream(self, inStream, outStream):
+        """Write decoded contents of one file-like object to another, returning the decoded size"""
+        return copyTransformed(inStream, outStream, self.decompressor())
+
+    def __repr__(self):
+        return "<Codec %s>" % self.name
+
+def copyTransformed(inStream, outStream, transformer):
+    """Copy data through a compressor or decompressor, a block at a time"""
+    size = 0
+    transform = hasattr(transformer, "compress") and transformer.compress or transformer.decompress
+    while True:
+        block = inStream.read(CodecBlockSize)
+        if not block:
+            break
+        output = transform(block)
+        outStream.write(output)
+        size += len(output)
+    output = transformer.flush()
+    outStream.write(output)
+    return size + len(output)
+
+Codecs = {"zlib": Codec("zlib", zlib.compressobj, zlib.decompressobj),
+          "bz2": Codec("bz2", bz2.BZ2Compressor, bz2.BZ2Decompressor)}
+if lzma is not None:
+    Codecs["lzma"] = Codec("lzma", lzma.LZMACompressor, lzma.LZMADecompressor)
+
+def getCodec(name):
+    """Get a codec by name"""
+    if name not in Codecs:
+        raise UnknownCodec(name)
+    return Codecs[name]
+
+# File types whose contents are normally compressed already
+DefaultIncompressibleExtensions = set([
+        ".gz", ".tgz", ".bz2", ".tbz", ".xz", ".txz", ".lzma", ".zip", ".7z", ".rar", ".z", ".lz", ".zst",
+        ".jar", ".war", ".apk", ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp", ".epub",
+        ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+        ".mp3", ".m4a", ".aac", ".ogg", ".oga", ".opus", ".flac",
+        ".mp4", ".m4v", ".mkv", ".mov", ".avi", ".webm", ".wmv", ".flv"])
+
+class CompressionPolicy(object):
+    """Which codec (if any) to use for the contents of a file being backed up.
+    Files with names ending in one of the skipExtensions are not compressed, and nor
+    is any content where compression saves less than the fraction minSaving of it's size."""
+    def __init__(self, codecName = "zlib", minSaving = 0.1, skipExtensions = DefaultIncompressibleExtensions):
+        self.codec = getCodec(codecName)
+        self.minSaving = minSaving
+        self.skipExtensions = skipExtensions
+
+    def codecForFile(self, fileName):
+        """The codec to try for a named file, or None if it shouldn't be compressed"""
+        extension = os.path.splitext(fileName)[1].lower()
+        if extension in self.skipExtensions:
+            return None
+        return self.codec
+
+    def worthwhile(self, size, encodedSize):
+        """Is encoding which reduces size bytes to encodedSize bytes worth doing?"""
+        return encodedSize <= size * (1.0 - self.minSaving)
@@ -19,6 +19,7 @@
 # THE SOFTWARE.
 
 import os, sys
+from DirectoryWalker import listDirectory, listDirectoryByName
 
 class DirectoryComparator:
     def __init__(self, base1, base2, log, logDiff):
@@ -34,31 +35,33 @@ class DirectoryComparator:
         dir1 = subPath and os.path.join(self.base1, subPath) or self.base1
         dir2 = subPath and os.path.join(self.base2, subPath) or self.base2
         self.log(indent, "comparing directories %s and %s ..." % (dir1, dir2))
+        dir2Children = listDirectoryByName(dir2)
         dir1ChildrenSet = set()
-        for name1 in os.listdir(dir1):
+        for child1 in listDirectory(dir1):
+            name1 = child1.name
             dir1ChildrenSet.add (name1)
-            child1Path = os.path.join(dir1, name1)
-            child2Path = os.path.join(dir2, name1)
+            child2 = dir2Children.get(name1)
             childSubPath = subPath and ("%s/%s" % (subPath, name1)) or name1
-            if os.path.isdir(child1Path):
-                if os.path.exists(child2Path):
-                    if os.path.isfile(child2Path):
+            if child1.isDir:
+                if child2 is not None:
+                    if child2.isFile:
                         self.logDiff ("%s is a directory in %s but a file in %s" % 
                                       (childSubPath, self.base1, self.base2))
-                    elif os.path.isdir(child2Path):
+                    elif child2.isDir:
                         self.compareDirs(childSubPath, indent = indent+1)
                     else:
                         self.logDiff("Unknown object %s in %s" % (childSubPath, self.base2))
                 else:
                     self.logDiff("%s is a directory in %s but does not exist in %s" % 
                                  (childSubPath, self.base1, self.base2))
-            elif os.path.isfile(child1Path):
-                if os.path.exists(child2Path):
-                    if os.path.isdir(child2Path):
+            elif child1.isFile:
+                if child2 is not None:
+                    if child2.isDir:
                         self.logDiff("%s is a file in %s but a directory in %s" % 
                                      (childSubPath, self.base1, self.base2))
-                    elif os.path.isfile(child2Path):
-                        self.compareFiles(subPath = childSubPath, indent = indent+1)
+                    elif child2.isFile:
+                        self.compareFiles(subPath = childSubPath, indent = indent+1, 
+                                          entry1 = child1, entry2 = child2)
                     else:
                         self.logDiff("Unknown object %s in %s" % (childSubPath, self.base2))
                 else:
@@ -66,30 +69,50 @@ class DirectoryComparator:
                                  (childSubPath, self.base1, self.base2))
             else:
                 self.logDiff("Unknown object %s in %s" % (childSubPath, self.base1))
-        for name2 in os.listdir(dir2):
+        for name2, child2 in dir2Children.iteritems():
             if not name2 in dir1ChildrenSet:
-                child1Path = os.path.join(dir1, name2)
-                child2Path = os.path.join(dir2, name2)
                 childSubPath = subPath and ("%s/%s" % (subPath, name2)) or name2
-                if os.path.isdir(child2Path):
+                if child2.isDir:
                     self.logDiff("%s does not exist in %s but is a directory in %s" % 
                                  (childSubPath, self.base1, self.base2))
-                elif os.path.isfile(child2Path):
+                elif child2.isFile:
                     self.logDiff("%s does not exist in %s but is a file in %s" % 
                                  (childSubPath, self.base1, self.base2))
                 else:
                     self.logDiff("Unknown object %s in %s" % (childSubPath, self.base2))
                     
-    def compareFiles(self, indent, subPath):
-        """Compare the specified file within each base directory"""
+    def compareFiles(self, indent, subPath, entry1 = None, entry2 = None):
+        """Compare the specified file within each base directory 
+        (DirectoryEntry's for the files can be passed in if already known)"""
         file1 = os.path.join(self.base1, subPath)
         file2 = os.path.join(self.base2, subPath)
         self.log(indent, "comparing files %s and %s ..." % (file1, file2))
-        contents1 = file(file1, "rb").read()
-        contents2 = file(file2, "rb").read()
-        if contents1 != contents2:
+        if entry1 is not None and entry2 is not None and entry1.size != entry2.size:
+            self.logDiff("File %s has different sizes in %s and %s" % (subPath, self.base1, self.base2))
+        elif not sameFileContents(file1, file2):
             self.logDiff("File %s has different contents in %s and %s" % (subPath, self.base1, self.base2))
             
+# Size of blocks in which files are read when comparing them
+CompareChunkSize = 1024 * 1024
+
+def sameFileContents(file1, file2):
+    """Do two files have the same contents? (compared block by block)"""
+    f1 = file(file1, "rb")
+    try:
+        f2 = file(file2, "rb")
+        try:
+            while True:
+                chunk1 = f1.read(CompareChunkSize)
+                chunk2 = f2.read(CompareChunkSize)
+                if chunk1 != chunk2:
+                    return False
+                if not chunk1:
+                    return True
+        finally:
+            f2.close()
+    finally:
+        f1.close()
+        
 def printLog(indent, message):
     """Simple implementation for progress logger"""
     print "%s%r" % ("  " * indent, message)
@@ -0,0 +1,121 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import math
+
+# numpy (if it is installed) is used to find chunk boundaries a block at a time, otherwise
+# the rolling hash is calculated one byte at a time in Python
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def makeGearTable():
+    """256 pseudo-random 32-bit values, one for each byte value, derived from SHA1
+    (so that they never change, because chunk boundaries depend on them)"""
+    return [int(hashlib.sha1(chr(byte)).hexdigest()[:8], 16) for byte in range(256)]
+
+GearTable = makeGearTable()
+
+if numpy is not None:
+    GearArray = numpy.array(GearTable, dtype = numpy.uint32)
+    
+# Number of bytes for which the rolling hash is calculated at once when using numpy
+VectorBlockSize = 256 * 1024
+
+# Size of blocks read from the stream being chunked
+ChunkerReadSize = 1024 * 1024
+
+class ContentDefinedChunker(object):
+    """Splits a stream of bytes into chunks whose boundaries depend only on the content near each
+    boundary (using a "gear" rolling hash), so that inserting or changing bytes in one place
+    of a file only changes the chunks near that place, and all other chunks stay the same.
+    Chunks are at least minSize bytes (except possibly the last) and at most maxSize bytes,
+    and on average about avgSize bytes."""
+
+    def __init__(self, minSize = 256 * 1024, avgSize = 1024 * 1024, maxSize = 4 * 1024 * 1024):
+        if not (0 < minSize < avgSize < maxSize):
+            raise ValueError("Chunk sizes must satisfy 0 < minSize < avgSize < maxSize")
+        self.minSize = minSize
+        self.avgSize = avgSize
+        self.maxSize = maxSize
+        bits = max(1, int(round(math.log(avgSize - minSize, 2))))
+        # the high bits of a gear hash depend on the most bytes, so use those
+        self.mask = ((1 << bits) - 1) << (32 - bits)
+
+    def findBoundary(self, data):
+        """Length of the next chunk at the start of data (which is assumed to be either at least
+        maxSize long, or else all the remaining data). No boundary is looked for in the first minSize bytes.
+        With numpy this scans about 100MB/s (mostly without holding the GIL), otherwise (one byte at a time
+        in Python) only about 10MB/s, which is too slow for chunking multi-GB files."""
+        end = min(len(data), self.maxSize)
+        if end <= self.minSize:
+            return end
+        if numpy is not None:
+            return self.findBoundaryVectorized(data, end)
+        gear = GearTable
+        mask = self.mask
+        hash = 0
+        pos = self.minSize
+        for byte in bytearray(data[self.minSize:end]):
+            hash = ((hash << 1) + gear[byte]) & 0xFFFFFFFF
+            pos += 1
+            if not hash & mask:
+                return pos
+        return end
+    
+    def findBoundaryVectorized(self, data, end):
+        """Same as findBoundary, but using numpy to calculate the rolling hash for a block of positions at once.
+        The hash after each byte only depends on the last 32 bytes (from minSize onwards), i.e. it is 
+        the sum of gear[byte] << distance over those bytes, which is summed for all positions in a block 
+        by doubling the width of the sums 5 times."""
+        mask = numpy.uint32(self.mask)
+        blockStart = self.minSize
+        while blockStart < end:
+            blockEnd = min(end, blockStart + VectorBlockSize)
+            contextStart = max(self.minSize, blockStart - 31)
+            hashes = GearArray.take(numpy.frombuffer(data, numpy.uint8, blockEnd - contextStart, contextStart))
+            width = 1
+            while width < 32:
+                hashes[width:] += hashes[:-width] << width
+                width *= 2
+            boundaries = numpy.flatnonzero((hashes[blockStart - contextStart:] & mask) == 0)
+            if len(boundaries) > 0:
+                return blockStart + int(boundaries[0]) + 1
+            blockStart = blockEnd
+        return end
+    
+    def chunks(self, stream):
+        """Yield the chunks of everything read from a file-like object"""
+        buffer = ""
+        endOfStream = False
+        while True:
+            while not endOfStream and len(buffer) < self.maxSize:
+                data = stream.read(ChunkerReadSize)
+                if data:
+                    buffer += data
+                else:
+                    endOfStream = True
+            if not buffer:
+                return
+            boundary = self.findBoundary(buffer)
+            yield buffer[:boundary]
+            buffer = buffer[boundary:]
@@ -0,0 +1,102 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import stat
+
+# Use scandir (built in from Python 3.5, otherwise the "scandir" package if it is installed),
+# which gets file types from the directory listing itself. Otherwise fall back to
+# listdir plus one stat call per entry.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+class DirectoryEntry(object):
+    """A file or directory found when listing a directory (symbolic links are followed,
+    as for os.path.isfile and os.path.isdir). Stat details are only fetched when asked for,
+    and at most once."""
+    def __init__(self, name, path, isDir, isFile, statResult = None, scandirEntry = None):
+        self.name = name
+        self.path = path
+        self.isDir = isDir
+        self.isFile = isFile
+        self.statResult = statResult
+        self.scandirEntry = scandirEntry
+
+    def stat(self):
+        """Return the stat details of the file or directory"""
+        if self.statResult is None:
+            if self.scandirEntry is not None:
+                self.statResult = self.scandirEntry.stat()
+            else:
+                self.statResult = os.stat(self.path)
+        return self.statResult
+
+    @property
+    def size(self):
+        return self.stat().st_size
+
+    @property
+    def mtime(self):
+        return self.stat().st_mtime
+
+    def __repr__(self):
+        return "<DirectoryEntry %r%s>" % (self.path, self.isDir and " (dir)" or "")
+
+def listDirectory(path):
+    """Yield a DirectoryEntry for each file, directory or other object in a directory"""
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                isDir = entry.is_dir()
+                isFile = not isDir and entry.is_file()
+            except OSError:
+                isDir = isFile = False
+            yield DirectoryEntry(entry.name, entry.path, isDir, isFile, scandirEntry = entry)
+    else:
+        for name in os.listdir(path):
+            childPath = os.path.join(path, name)
+            try:
+                statResult = os.stat(childPath)
+            except OSError:
+                yield DirectoryEntry(name, childPath, False, False)
+            else:
+                isDir = stat.S_ISDIR(statResult.st_mode)
+                isFile = stat.S_ISREG(statResult.st_mode)
+                yield DirectoryEntry(name, childPath, isDir, isFile, statResult = statResult)
+
+def listDirectoryByName(path):
+    """Return a map from names to DirectoryEntry's for all the objects in a directory"""
+    return dict((entry.name, entry) for entry in listDirectory(path))
+
+def walkTree(basePath, relativePath = u""):
+    """Recursively walk a sub-directory (specified by a '/'-separated relative path starting with '/',
+    or u"" for the base directory itself), yielding (childRelativePath, entry) for every contained
+    object, with each directory yielded before its contents."""
+    for entry in listDirectory(basePath + relativePath):
+        childRelativePath = relativePath + "/" + entry.name
+        yield (childRelativePath, entry)
+        if entry.isDir:
+            for descendant in walkTree(basePath, childRelativePath):
+                yield descendant
@@ -0,0 +1,53 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# gevent is optional: it is only needed to run tasks on greenlets
+try:
+    import gevent
+    import gevent.monkey
+except ImportError:
+    gevent = None
+    
+from ThreadedTaskRunner import ThreadedTaskRunner
+
+def patchForGreenlets():
+    """Make the standard library (sockets, threads, queues, sleep etc.) cooperative with greenlets.
+    This must be called at the start of the program, before boto (or anything else that 
+    uses sockets or threads) is imported."""
+    if gevent is None:
+        raise ImportError("gevent is required to run tasks on greenlets")
+    gevent.monkey.patch_all()
+    
+class GreenletTaskRunner(ThreadedTaskRunner):
+    """Task runner whose workers are greenlets instead of OS threads, so that hundreds of requests
+    (e.g. for small values in an S3 bucket map) can be in progress at once from a single process.
+    
+    This is the same as ThreadedTaskRunner, running in a program where patchForGreenlets has
+    been called, so that the worker "threads" are greenlets, and the blocking socket operations done
+    by tasks (and by boto on their behalf) switch to other greenlets instead of blocking
+    (with each request using a connection from the bucket map's connection pool)."""
+    def __init__(self, checkpointFreq = 500, numGreenlets = 200, maxTasksInProgress = None, 
+                 retryPolicy = None, concurrency = None):
+        if gevent is None:
+            raise ImportError("gevent is required to run tasks on greenlets")
+        if not gevent.monkey.is_module_patched("socket") or not gevent.monkey.is_module_patched("threading"):
+            raise Exception("patchForGreenlets() must be called (at program start) before using GreenletTaskRunner")
+        super(GreenletTaskRunner, self).__init__(checkpointFreq, numGreenlets, maxTasksInProgress, 
+                                                 retryPolicy, concurrency)
@@ -0,0 +1,115 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import cPickle
+import os
+import threading
+import time
+
+# Files modified less than this many seconds before the cache was opened are not
+# cached, because a later modification within the same mtime tick would not change
+# their stat details.
+RacyInterval = 2.0
+
+class HashCache(object):
+    """Persistent local record of the SHA1 hashes of files, keyed on each file's full path.
+    A cached hash is only used if the file's size, mtime, inode and ctime are all
+    the same as when the hash was calculated, otherwise the file has to be read and hashed again.
+
+    Only entries for files looked up since the cache was opened are saved, so that files
+    which no longer exist are dropped from the cache.
+    """
+
+    def __init__(self, filename):
+        """Open the cache stored in the named file (which need not exist yet)"""
+        self.filename = filename
+        self.openedTime = time.time()
+        self.entries = self.load()
+        self.usedEntries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Read the saved entries (a missing or unreadable cache file is treated as empty)"""
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            f = file(self.filename, "rb")
+            try:
+                entries = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            print "WARNING: ignoring unreadable hash cache %r (%s)" % (self.filename, e)
+            return {}
+        if not isinstance(entries, dict):
+            print "WARNING: ignoring invalid hash cache %r" % self.filename
+            return {}
+        return entries
+
+    @staticmethod
+    def cachePath(filename):
+        return os.path.normpath(os.path.abspath(filename))
+
+    @staticmethod
+    def statKey(statResult):
+        """The stat details which must be unchanged for a cached hash to be valid"""
+        return (statResult.st_size, statResult.st_mtime, statResult.st_ino, statResult.st_ctime)
+
+    def getHash(self, filename, statResult):
+        """Return the cached hash of the named file with the given (current) stat details,
+        or None if there is no valid cached hash."""
+        path = HashCache.cachePath(filename)
+        statKey = HashCache.statKey(statResult)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == statKey:
+                self.usedEntries[path] = entry
+                self.hits += 1
+                return entry[1]
+            else:
+                self.misses += 1
+                return None
+
+    def recordHash(self, filename, statResult, hash):
+        """Record the hash of a file calculated from its contents, where the stat details
+        were taken _before_ reading the contents."""
+        if statResult.st_mtime >= self.openedTime - RacyInterval:
+            return
+        path = HashCache.cachePath(filename)
+        entry = (HashCache.statKey(statResult), hash)
+        with self.lock:
+            self.entries[path] = entry
+            self.usedEntries[path] = entry
+
+    def save(self):
+        """Save the entries used since the cache was opened, replacing the cache file atomically"""
+        print "Saving hash cache %r (%d hits, %d misses) ..." % (self.filename, self.hits, self.misses)
+        tempFilename = self.filename + ".tmp"
+        with self.lock:
+            f = file(tempFilename, "wb")
+            try:
+                cPickle.dump(self.usedEntries, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+        if os.name == "nt" and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tempFilename, self.filename)
@@ -0,0 +1,68 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import cStringIO
+import gzip
+import json
+import yaml
+
+# Manifests (lists of records such as path summaries) are written as gzip'd JSON lines, i.e. one 
+# JSON record per line, which is much more compact and much quicker to parse than YAML.
+# Manifests written by older versions are YAML, and are recognised by not starting with the gzip header.
+
+GzipHeader = "\x1f\x8b"
+
+# Use the libyaml-based loader (if available) for reading old YAML manifests
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+def dumpManifest(records):
+    """Convert a list of records (JSON-compatible data) into manifest content"""
+    output = cStringIO.StringIO()
+    gzipFile = gzip.GzipFile(fileobj = output, mode = "wb", compresslevel = 6, mtime = 0)
+    try:
+        for record in records:
+            gzipFile.write(json.dumps(record, separators = (",", ":")))
+            gzipFile.write("\n")
+    finally:
+        gzipFile.close()
+    return output.getvalue()
+
+def isYamlManifest(content):
+    return not content.startswith(GzipHeader)
+
+def iterManifest(content):
+    """Yield the records of manifest content (or the items of old YAML manifest content)"""
+    if isYamlManifest(content):
+        data = yaml.load(content, Loader = YamlLoader)
+        if data is not None:
+            for record in data:
+                yield record
+    else:
+        gzipFile = gzip.GzipFile(fileobj = cStringIO.StringIO(content), mode = "rb")
+        try:
+            for line in gzipFile:
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            gzipFile.close()
+            
+def loadManifest(content):
+    """Get the list of records from manifest content (or the data of old YAML manifest content)"""
+    return list(iterManifest(content))
@@ -0,0 +1,129 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+import time
+
+def parseTimeOfDay(timeOfDay):
+    """Minutes after midnight of a time of day "HH:MM" """
+    hours, minutes = timeOfDay.split(":")
+    return int(hours) * 60 + int(minutes)
+
+class RateSchedule(object):
+    """Rates (e.g. in bytes per second) which depend on the time of day, given as a list of
+    (startTime, rate) where startTime is "HH:MM" (local time), and each rate applies from it's start 
+    time until the next start time (wrapping around midnight). A rate of None means unlimited.
+    For example, [("08:00", 512 * 1024), ("19:00", None)] limits the rate to 512KB/s during the day only."""
+    def __init__(self, entries):
+        if not entries:
+            raise ValueError("A rate schedule needs at least one entry")
+        self.entries = sorted((parseTimeOfDay(startTime), rate) for startTime, rate in entries)
+        
+    def rateAt(self, timestamp = None):
+        """The rate at a time (default now)"""
+        localTime = time.localtime(timestamp)
+        minutes = localTime.tm_hour * 60 + localTime.tm_min
+        rate = self.entries[-1][1] # (before the first start time, the last rate of the previous day applies)
+        for startMinutes, entryRate in self.entries:
+            if startMinutes > minutes:
+                break
+            rate = entryRate
+        return rate
+    
+    def __repr__(self):
+        return "<RateSchedule %s>" % ", ".join("%02d:%02d %s" % (minutes // 60, minutes % 60, rate) 
+                                               for minutes, rate in self.entries)
+    
+class RateLimiter(object):
+    """Token-bucket limit on the total rate of transfer of bytes (by all threads sharing the limiter).
+    The rate is either fixed (rate bytes per second, or None for unlimited), or else given by a RateSchedule. 
+    Up to 'burst' bytes (default one second's worth) can be transferred at once after a pause, 
+    otherwise each transfer waits until enough tokens have accumulated for it. 
+    So that there can be many transfers in progress at once (to hide the latency of each request), 
+    while the total transfer rate is held to the limit, each transfer calls consume() for each 
+    block of data as it goes (see transferCallback)."""
+    def __init__(self, rate = None, schedule = None, burst = None):
+        self.rate = rate
+        self.schedule = schedule
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = None
+        self.lastTime = time.time()
+        
+    def currentRate(self):
+        if self.schedule is not None:
+            return self.schedule.rateAt()
+        else:
+            return self.rate
+        
+    def capacity(self, rate):
+        return self.burst if self.burst is not None else rate
+    
+    def consume(self, numBytes):
+        """Take tokens for numBytes bytes, waiting until they are available (tokens are taken immediately, 
+        so that a later caller waits behind an earlier one, even if the earlier one is still waiting)"""
+        rate = self.currentRate()
+        with self.lock:
+            now = time.time()
+            if not rate:
+                self.tokens = None
+                self.lastTime = now
+                return
+            capacity = self.capacity(rate)
+            if self.tokens is None:
+                self.tokens = capacity
+            else:
+                self.tokens = min(capacity, self.tokens + (now - self.lastTime) * rate)
+            self.lastTime = now
+            self.tokens -= numBytes
+            delay = -self.tokens / float(rate)
+        if delay > 0:
+            time.sleep(delay)
+            
+    def __repr__(self):
+        if self.schedule is not None:
+            return "<RateLimiter %r>" % self.schedule
+        else:
+            return "<RateLimiter %s bytes/s>" % self.rate
+        
+def transferCallback(limiter):
+    """A progress callback for boto transfers (i.e. called with the total bytes transferred so far), 
+    which consumes tokens from the limiter as the bytes are transferred (or None if there is no limiter)"""
+    if limiter is None:
+        return None
+    transferred = [0]
+    def callback(bytesSoFar, totalBytes):
+        if bytesSoFar < transferred[0]: # the transfer has been restarted
+            transferred[0] = 0
+        limiter.consume(bytesSoFar - transferred[0])
+        transferred[0] = bytesSoFar
+    return callback
+
+def getRateLimiter(rate = None, schedule = None):
+    """A rate limiter given a rate (bytes per second), or a schedule as a RateSchedule or 
+    a list of (startTime, rate), or None if neither is given"""
+    if schedule is not None:
+        if not isinstance(schedule, RateSchedule):
+            schedule = RateSchedule(schedule)
+        return RateLimiter(schedule = schedule)
+    elif rate is not None:
+        return RateLimiter(rate)
+    else:
+        return None
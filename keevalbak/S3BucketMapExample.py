@@ -72,6 +72,11 @@ def main():
 
     testContains(bucketMap, "jim")
     testContains(bucketMap, "testValue")
+    
+    print "get(jim) = %r, get(testValue) = %r" % (bucketMap.get("jim"), bucketMap.get("testValue"))
+    bucketMap.cacheExistence()
+    testContains(bucketMap, "jim")
+    testContains(bucketMap, "testValue")
 
 if __name__ == '__main__':
     main()
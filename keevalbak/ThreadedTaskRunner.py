@@ -20,70 +20,343 @@
 
 import Queue
 import threading
+import random
+import socket
+import httplib
+import time
+import traceback
 
+class TransientTaskError(Exception):
+    """An error which a task can raise to indicate that it may succeed if tried again"""
+    pass
+
+# HTTP statuses (e.g. of S3 responses) for which a request may succeed if tried again
+TransientHttpStatuses = set([408, 429, 500, 502, 503, 504])
+
+def isTransientError(exception):
+    """Is an exception raised by a task one that might not happen if the task was tried again?
+    (i.e. network errors, and HTTP errors with "try again" statuses)"""
+    if isinstance(exception, (TransientTaskError, socket.error, httplib.HTTPException)):
+        return True
+    return getattr(exception, "status", None) in TransientHttpStatuses
+
+class RetryPolicy(object):
+    """How often, and after what delay, a task which fails with a transient error is tried again:
+    up to maxAttempts attempts in total, with delays starting at initialDelay seconds and multiplied
+    by backoffFactor for each further attempt (up to maxDelay), each delay being randomly reduced
+    by up to the fraction jitter (so that failing tasks don't all retry at the same moment)."""
+    def __init__(self, maxAttempts = 5, initialDelay = 1.0, backoffFactor = 2.0, maxDelay = 60.0, jitter = 0.5, 
+                 isRetryable = isTransientError):
+        self.maxAttempts = maxAttempts
+        self.initialDelay = initialDelay
+        self.backoffFactor = backoffFactor
+        self.maxDelay = maxDelay
+        self.jitter = jitter
+        self.isRetryable = isRetryable
+        
+    def delay(self, attempt):
+        """Delay before the next attempt after attempt number 'attempt' (counting from 1) failed"""
+        delay = min(self.maxDelay, self.initialDelay * self.backoffFactor ** (attempt-1))
+        return delay * (1.0 - self.jitter * random.random())
+    
+def doUnsynchronizedWithRetries(task, retryPolicy):
+    """Do the unsynchronized part of a task, retrying it after transient errors as specified
+    by the retry policy (and raising the last error if it doesn't succeed), returning the number of attempts"""
+    attempt = 1
+    while True:
+        try:
+            task.doUnsynchronized()
+            return attempt
+        except Exception, e:
+            if attempt >= retryPolicy.maxAttempts or not retryPolicy.isRetryable(e):
+                e.taskAttempts = attempt # (so that the number of attempts made is known when the task fails)
+                raise
+            delay = retryPolicy.delay(attempt)
+            print "Retrying %r in %.1fs after error (attempt %d): %s" % (task, delay, attempt, e)
+            time.sleep(delay)
+            attempt += 1
+            
+class TaskFailure(object):
+    """A task which failed (after any retries), with the error and a description of it"""
+    def __init__(self, task, exception, description):
+        self.task = task
+        self.exception = exception
+        self.description = description
+        
+    def __repr__(self):
+        return "<TaskFailure %r: %s>" % (self.task, self.exception)
+            
+class TasksFailed(Exception):
+    """Raised after running tasks, if any of the tasks failed"""
+    def __init__(self, failures):
+        Exception.__init__(self, "%d task(s) failed, first failure: %s" % (len(failures), failures[0].exception))
+        self.failures = failures
+        
+# Number of tasks run at once by an AdaptiveConcurrency to start with (the same as the default task runner)
+DefaultInitialWorkers = 30
+
+class AdaptiveConcurrency(object):
+    """AIMD (additive-increase, multiplicative-decrease) control of how many tasks a ThreadedTaskRunner
+    runs at once, between minWorkers and maxWorkers, starting from initialWorkers (default DefaultInitialWorkers). 
+    Every sampleInterval seconds, if tasks completed without errors and throughput (tasks completed per second) 
+    didn't fall, the limit is doubled (until the first sign of congestion, like TCP slow start) and
+    afterwards increased by increaseStep. It is multiplied by decreaseFactor if there were any transient errors
+    (including retried ones), or if throughput fell while task latency rose by more than the factor latencyTolerance 
+    above the lowest latency seen so far. Tasks failing with permanent errors (e.g. a missing source file)
+    are not counted as errors, because they aren't a sign of congestion."""
+    def __init__(self, minWorkers = 4, maxWorkers = 128, initialWorkers = None, sampleInterval = 1.0, 
+                 increaseStep = 2, decreaseFactor = 0.75, latencyTolerance = 2.0):
+        self.minWorkers = minWorkers
+        self.maxWorkers = maxWorkers
+        self.limit = max(minWorkers, min(maxWorkers, initialWorkers or DefaultInitialWorkers))
+        self.slowStart = True
+        self.sampleInterval = sampleInterval
+        self.increaseStep = increaseStep
+        self.decreaseFactor = decreaseFactor
+        self.latencyTolerance = latencyTolerance
+        self.lastThroughput = None
+        self.lowestLatency = None
+        self.startSample()
+        
+    def startSample(self):
+        self.sampleStartTime = time.time()
+        self.sampleTasks = 0
+        self.sampleErrors = 0
+        self.sampleTotalLatency = 0.0
+        
+    def recordTask(self, latency, attempts, failedTransiently):
+        """Record the completion of a task (which took 'attempts' attempts, and 'latency' seconds in total, 
+        and failedTransiently if it's last attempt failed with a transient error)"""
+        self.sampleTasks += 1
+        self.sampleTotalLatency += latency
+        self.sampleErrors += attempts - 1 + (failedTransiently and 1 or 0)
+        elapsed = time.time() - self.sampleStartTime
+        if elapsed >= self.sampleInterval:
+            self.adjust(self.sampleTasks / elapsed, self.sampleTotalLatency / self.sampleTasks, self.sampleErrors)
+            self.startSample()
+            
+    def adjust(self, throughput, latency, errors):
+        """Adjust the limit given the throughput, mean latency and number of errors of the last sample"""
+        if self.lowestLatency is None or latency < self.lowestLatency:
+            self.lowestLatency = latency
+        congested = (self.lastThroughput is not None and throughput < self.lastThroughput
+                     and latency > self.lowestLatency * self.latencyTolerance)
+        if errors > 0 or congested:
+            newLimit = max(self.minWorkers, int(self.limit * self.decreaseFactor))
+            self.slowStart = False
+        elif self.slowStart:
+            newLimit = min(self.maxWorkers, self.limit * 2)
+        else:
+            newLimit = min(self.maxWorkers, self.limit + self.increaseStep)
+        if newLimit != self.limit:
+            print "CONCURRENCY: %d -> %d (%.1f tasks/s, latency %.2fs, %d errors)" % (self.limit, newLimit, throughput, 
+                                                                                  latency, errors)
+        self.limit = newLimit
+        self.lastThroughput = throughput
+        
 class TaskRunner(object):
     """Simple task runner: runs both parts of tasks synchronously"""
-    def __init__(self, checkpointFreq = None):
+    def __init__(self, checkpointFreq = None, retryPolicy = None):
         self.checkpointFreq = checkpointFreq
+        self.retryPolicy = retryPolicy or RetryPolicy()
         
     def runTasksInit(self):
-        pass
+        self.failures = []
     
-    def doUnsynchronizedTasks(self, tasks):
-        for task in tasks:
-            task.doUnsynchronized()
-        
     def runTasks(self, tasks, checkpointTask = None):
+        """Run a list of tasks (see runTaskStream)"""
+        self.runTaskStream(iter(tasks), checkpointTask)
+            
+    def runTaskStream(self, tasks, checkpointTask = None):
+        """Run tasks taken from an iterator (which may be still generating them), doing a checkpoint
+        after every checkpointFreq tasks have completed. Tasks which fail (after any retries) are
+        skipped, and reported by raising TasksFailed once all the other tasks have been run."""
         self.runTasksInit()
-        startIndex = 0
-        numTasks = len(tasks)
-        while startIndex < numTasks:
-            if self.checkpointFreq == None or checkpointTask == None:
-                endIndex = numTasks
-            else:
-                endIndex = min(startIndex+self.checkpointFreq, numTasks)
-            self.doUnsynchronizedTasks (tasks[startIndex:endIndex])
-            for i in range(startIndex, endIndex):
-                tasks[i].doSynchronized()
-            if endIndex < numTasks:
-                print "CHECKPOINT:"
-                if checkpointTask != None:
-                    checkpointTask.checkpoint()
-            startIndex = endIndex
+        numCompleted = 0
+        for task in tasks:
+            try:
+                doUnsynchronizedWithRetries(task, self.retryPolicy)
+            except Exception, e:
+                self.recordFailure(TaskFailure(task, e, traceback.format_exc()))
+                continue
+            task.doSynchronized()
+            numCompleted += 1
+            self.checkpointIfDue(numCompleted, checkpointTask)
+        self.reportFailures()
+            
+    def shutdown(self):
+        """Stop any worker threads (once the runner is no longer needed)"""
+        pass
+    
+    def checkpointIfDue(self, numCompleted, checkpointTask):
+        if self.checkpointFreq != None and checkpointTask != None and numCompleted % self.checkpointFreq == 0:
+            print "CHECKPOINT:"
+            checkpointTask.checkpoint()
+            
+    def recordFailure(self, failure):
+        print "TASK FAILED: %r\n%s" % (failure.task, failure.description)
+        self.failures.append (failure)
+        
+    def reportFailures(self):
+        """Print a summary of failed tasks (if any) and raise TasksFailed"""
+        if len(self.failures) > 0:
+            print ""
+            print "%d TASK(S) FAILED:" % len(self.failures)
+            for failure in self.failures:
+                print "  %r: %s" % (failure.task, failure.exception)
+            raise TasksFailed(self.failures)
             
 class TaskProcessor(threading.Thread):
-    def __init__(self, queue, index):
+    def __init__(self, queue, doneQueue, index, retryPolicy):
         threading.Thread.__init__(self)
         self.queue = queue
+        self.doneQueue = doneQueue
         self.index = index
+        self.retryPolicy = retryPolicy
         self.threadLocals = None
+        self.currentTask = None
 
     def run(self):
         while True:
             task = self.queue.get()
-            if self.threadLocals == None:
-                self.threadLocals = task.getThreadLocals()
-            #print "Thread %d performing task ..." % self.index
-            for key, value in self.threadLocals.iteritems():
-                task.__dict__[key] = value
-            task.doUnsynchronized()
+            if task is None: # (see ThreadedTaskRunner.shutdown)
+                self.queue.task_done()
+                return
+            self.currentTask = task
+            startTime = time.time()
+            try:
+                # (tasks may optionally define getThreadLocals, giving values to be set on all
+                # the tasks done by the same worker thread)
+                if self.threadLocals == None:
+                    self.threadLocals = hasattr(task, "getThreadLocals") and task.getThreadLocals() or {}
+                #print "Thread %d performing task ..." % self.index
+                for key, value in self.threadLocals.iteritems():
+                    task.__dict__[key] = value
+                attempts = doUnsynchronizedWithRetries(task, self.retryPolicy)
+                result = (task, None, time.time() - startTime, attempts)
+            except Exception, e:
+                # discard thread locals (e.g. connections) which may have been left in a bad state
+                self.threadLocals = None
+                result = (task, TaskFailure(task, e, traceback.format_exc()), time.time() - startTime, 
+                          getattr(e, "taskAttempts", 1))
+            self.currentTask = None
+            self.doneQueue.put (result)
             self.queue.task_done()
             #print "Thread %d finished performing task ..." % self.index
             
+# How often (in seconds) to check that worker threads are still alive, while waiting for tasks to complete
+WorkerCheckInterval = 5.0
+            
 class ThreadedTaskRunner(TaskRunner):
-    def __init__(self, checkpointFreq = 10, numThreads = 10):
-        super(ThreadedTaskRunner, self).__init__(checkpointFreq)
+    def __init__(self, checkpointFreq = 10, numThreads = 10, maxTasksInProgress = None, retryPolicy = None, 
+                 concurrency = None):
+        """Task runner with numThreads worker threads. When running a stream of tasks, at most
+        maxTasksInProgress (default twice the number of threads) are taken from the stream ahead of
+        those which have completed. Tasks failing with transient errors are retried according to
+        the retry policy.
+        If concurrency (AdaptiveConcurrency) is given, it decides how many tasks are in progress at
+        once while tasks are running (and numThreads is increased to concurrency.maxWorkers if less)."""
+        super(ThreadedTaskRunner, self).__init__(checkpointFreq, retryPolicy)
         self.queue = Queue.Queue()
-        self.processors = [TaskProcessor(self.queue, i) for i in range(numThreads)]
-        for processor in self.processors:
-            processor.setDaemon(True)
-            processor.start()
+        self.doneQueue = Queue.Queue()
+        self.maxTasksInProgress = maxTasksInProgress or 2 * numThreads
+        self.concurrency = concurrency
+        if concurrency is not None:
+            numThreads = max(numThreads, concurrency.maxWorkers)
+        self.processors = [self.startProcessor(i) for i in range(numThreads)]
+        
+    def startProcessor(self, index):
+        processor = TaskProcessor(self.queue, self.doneQueue, index, self.retryPolicy)
+        processor.setDaemon(True)
+        processor.start()
+        return processor
             
     def runTasksInit(self):
+        super(ThreadedTaskRunner, self).runTasksInit()
         for processor in self.processors:
             processor.threadLocals = None
+            
+    def replaceDeadProcessors(self):
+        """Replace any worker threads which have died (which should only happen if something
+        more drastic than an Exception happened), reporting the tasks they were doing as failed"""
+        for i, processor in enumerate(self.processors):
+            if not processor.isAlive():
+                print "WARNING: worker thread %d died, starting a new one" % i
+                if processor.currentTask is not None:
+                    self.doneQueue.put ((processor.currentTask, 
+                                         TaskFailure(processor.currentTask, None, "worker thread died"), 0.0, 1))
+                self.processors[i] = self.startProcessor(i)
                 
-    def doUnsynchronizedTasks(self, tasks):
-        for task in tasks:
-            self.queue.put (task)
-        self.queue.join()
+    def waitForTask(self, checkpointTask):
+        """Wait for a task in progress to complete (checking meanwhile that worker threads are still alive)"""
+        while True:
+            try:
+                result = self.doneQueue.get(timeout = WorkerCheckInterval)
+            except Queue.Empty:
+                self.replaceDeadProcessors()
+            else:
+                self.completeTask(result, checkpointTask)
+                return
+                
+    def runTaskStream(self, tasks, checkpointTask = None):
+        """Run tasks taken from an iterator (which may be still generating them), with the synchronized
+        part of each task done (in this thread) as soon as it's unsynchronized part is completed, 
+        and a checkpoint after every checkpointFreq completed tasks. Tasks are only taken from the iterator
+        when fewer than maxTasksInProgress are in progress, so that a large stream is never all in memory at once.
+        There is no waiting for the tasks in progress before a checkpoint: a checkpoint records whatever set
+        of tasks has completed so far (i.e. those whose synchronized parts have been done), while the
+        worker threads carry on with the tasks already queued.
+        Tasks which fail (after any retries) are skipped, and reported by raising TasksFailed once 
+        all the other tasks have been run."""
+        self.runTasksInit()
+        self.numInProgress = 0
+        self.numCompleted = 0
+        try:
+            for task in tasks:
+                while self.numInProgress >= self.tasksInProgressLimit():
+                    self.waitForTask(checkpointTask)
+                self.queue.put (task)
+                self.numInProgress += 1
+                while not self.doneQueue.empty():
+                    self.completeTask(self.doneQueue.get(), checkpointTask)
+            while self.numInProgress > 0:
+                self.waitForTask(checkpointTask)
+        except:
+            self.abandonTasksInProgress()
+            raise
+        self.reportFailures()
+    
+    def abandonTasksInProgress(self):
+        """Wait for the tasks in progress to finish, without doing their synchronized parts (when an error
+        has stopped a stream of tasks, so that they can't be mistaken for tasks of a later stream)"""
+        while self.numInProgress > 0:
+            try:
+                self.doneQueue.get(timeout = WorkerCheckInterval)
+            except Queue.Empty:
+                self.replaceDeadProcessors()
+            else:
+                self.numInProgress -= 1
+    
+    def shutdown(self):
+        """Stop the worker threads (after they have done any tasks already queued)"""
+        for processor in self.processors:
+            self.queue.put (None)
+    
+    def tasksInProgressLimit(self):
+        if self.concurrency is not None:
+            return self.concurrency.limit
+        else:
+            return self.maxTasksInProgress
+            
+    def completeTask(self, result, checkpointTask):
+        task, failure, latency, attempts = result
+        self.numInProgress -= 1
+        if self.concurrency is not None:
+            self.concurrency.recordTask(latency, attempts, 
+                                        failure is not None and self.retryPolicy.isRetryable(failure.exception))
+        if failure is not None:
+            self.recordFailure(failure)
+        else:
+            task.doSynchronized()
+            self.numCompleted += 1
+            self.checkpointIfDue(self.numCompleted, checkpointTask)
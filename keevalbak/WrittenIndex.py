@@ -0,0 +1,93 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import sqlite3
+
+class WrittenIndex(object):
+    """Persistent local index (a sqlite database) of where file contents and chunks with given
+    hashes were written to in a backup map, for backups in the current backup group, so that
+    an incremental backup does not have to download the written path lists of all previous backups.
+    
+    The index records which backups it holds the written records of, and whether each of those
+    backups was complete at the time, and it is validated against the current backup records
+    before use (see validate). It is only used from one thread.
+    """
+    
+    def __init__(self, filename):
+        """Open the index stored in the named file (which need not exist yet)"""
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.text_factory = str
+        self.connection.executescript("""
+            create table if not exists backups (datetime text primary key, completed integer);
+            create table if not exists written (hash text primary key, datetime text, path text);
+            create table if not exists chunks (hash text primary key, datetime text, codec text);
+            create index if not exists writtenDatetime on written (datetime);
+            create index if not exists chunksDatetime on chunks (datetime);""")
+        
+    def validate(self, backupRecords):
+        """Given the records of the backups whose written records are wanted, discard everything 
+        in the index for any other backups (or for incomplete backups, which may have been added to
+        after they were indexed), and return the list of backup records not (fully) held in the index."""
+        indexedCompleted = set(row[0] for row in 
+                               self.connection.execute("select datetime from backups where completed = 1"))
+        wanted = set(record.datetime for record in backupRecords if record.completed)
+        for (datetime, ) in list(self.connection.execute("select datetime from backups")):
+            if datetime not in wanted:
+                self.removeBackup(datetime)
+        self.connection.commit()
+        return [record for record in backupRecords if record.datetime not in indexedCompleted or not record.completed]
+    
+    def removeBackup(self, datetime):
+        print "Removing backup %s from written index ..." % datetime
+        self.connection.execute("delete from written where datetime = ?", (datetime, ))
+        self.connection.execute("delete from chunks where datetime = ?", (datetime, ))
+        self.connection.execute("delete from backups where datetime = ?", (datetime, ))
+        
+    def writtenEntries(self):
+        """Yield (hash, datetime, path) for all file contents in the index"""
+        return self.connection.execute("select hash, datetime, path from written")
+    
+    def chunkEntries(self):
+        """Yield (hash, datetime, codec) for all chunks in the index"""
+        return self.connection.execute("select hash, datetime, codec from chunks")
+    
+    def recordWritten(self, hash, datetime, path):
+        self.connection.execute("insert or replace into written values (?, ?, ?)", (hash, datetime, path))
+        
+    def recordChunk(self, hash, datetime, codec):
+        self.connection.execute("insert or replace into chunks values (?, ?, ?)", (hash, datetime, codec))
+        
+    def recordFileSummaries(self, datetime, fileSummariesYamlData):
+        """Record the file contents (and any chunks) written in a backup, given the YAML data of their file summaries"""
+        for fileData in fileSummariesYamlData:
+            self.recordWritten (fileData["hash"], datetime, fileData["path"])
+            for chunkData in fileData.get("chunks", []):
+                self.recordChunk (chunkData[1], chunkData[0], len(chunkData) > 2 and chunkData[2] or None)
+        
+    def recordIndexed(self, datetime, completed):
+        """Record that the written records of a backup (complete or not) are in the index"""
+        self.connection.execute("insert or replace into backups values (?, ?)", (datetime, completed and 1 or 0))
+        
+    def commit(self):
+        self.connection.commit()
+        
+    def close(self):
+        self.connection.close()
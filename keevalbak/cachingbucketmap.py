@@ -0,0 +1,231 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+# Default maximum total size of the values held in a DiskCache
+DefaultCacheSize = 1024 * 1024 * 1024
+
+# Prefix of temporary files written before being atomically renamed to cache files
+TempFilePrefix = ".tmp-"
+
+class DiskCache(object):
+    """Values stored as files in a local directory, up to a maximum total size, where the least
+    recently used values are removed when the total size would be exceeded. The directory can
+    be shared by successive runs, and all the methods can be called from any thread."""
+    
+    def __init__(self, directory, maxSize = DefaultCacheSize):
+        self.directory = directory
+        self.maxSize = maxSize
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.totalSize = 0
+        for name in os.listdir(directory):
+            if not name.startswith(TempFilePrefix):
+                statResult = os.stat(os.path.join(directory, name))
+                self.entries[name] = [statResult.st_size, statResult.st_mtime]
+                self.totalSize += statResult.st_size
+        with self.lock:
+            self.evict()
+            
+    def path(self, name):
+        return os.path.join(self.directory, name)
+    
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.entries
+        
+    def get(self, name):
+        """The cached value with a name, or None if it isn't cached"""
+        with self.lock:
+            if name not in self.entries:
+                return None
+            self.entries[name][1] = time.time()
+        try:
+            f = file(self.path(name), "rb")
+            try:
+                value = f.read()
+            finally:
+                f.close()
+            os.utime(self.path(name), None) # (so that the order of use is known by the next run)
+            return value
+        except (IOError, OSError):
+            self.remove(name)
+            return None
+        
+    def put(self, name, value):
+        """Cache a value with a name (unless it is bigger than the whole cache)"""
+        if len(value) > self.maxSize:
+            return
+        fd, tempFileName = tempfile.mkstemp(dir = self.directory, prefix = TempFilePrefix)
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                f.write(value)
+            finally:
+                f.close()
+            if os.name == "nt" and os.path.exists(self.path(name)):
+                os.remove(self.path(name))
+            os.rename(tempFileName, self.path(name))
+        except:
+            if os.path.exists(tempFileName):
+                os.remove(tempFileName)
+            raise
+        with self.lock:
+            if name in self.entries:
+                self.totalSize -= self.entries[name][0]
+            self.entries[name] = [len(value), time.time()]
+            self.totalSize += len(value)
+            self.evict()
+            
+    def remove(self, name):
+        with self.lock:
+            self.removeEntry(name)
+            
+    def removeEntry(self, name):
+        if name in self.entries:
+            self.totalSize -= self.entries.pop(name)[0]
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
+        
+    def evict(self):
+        """Remove the least recently used values until the total size is no more than maxSize"""
+        if self.totalSize > self.maxSize:
+            for name in sorted(self.entries, key = lambda name: self.entries[name][1]):
+                self.removeEntry(name)
+                if self.totalSize <= self.maxSize:
+                    break
+                
+    def __repr__(self):
+        return "<DiskCache %s, %d values, %d bytes>" % (self.directory, len(self.entries), self.totalSize)
+    
+# Keys (relative to the base of a backup map) of the manifests that never change once a backup has written them
+ImmutableManifestKeyRegex = re.compile(r"^[^/]+/(pathList|writtenPathList|version)$")
+
+def isImmutableManifestKey(key):
+    return ImmutableManifestKeyRegex.match(key) is not None
+
+class CachingBucketMap(object):
+    """Implementation of the same map methods as S3BucketMap, which reads and writes values in another
+    map, but keeps a copy of the values of some keys in a DiskCache (by default the manifests of backups
+    which never change once written, see isImmutableManifestKey), so that each of these values need only
+    be downloaded once by each host. Only values which exist are cached, and a cached value is removed
+    when it's key is deleted (e.g. when a backup is pruned) or written through this map.
+    
+    The namespace (by default the description of the other map, e.g. including the endpoint, bucket and prefix) 
+    identifies the map in the cache, so that one cache can be shared by different backup maps."""
+    
+    def __init__(self, backingMap, cache, namespace = None, prefix = "", isCacheable = isImmutableManifestKey):
+        self.backingMap = backingMap
+        self.cache = cache
+        self.namespace = namespace if namespace is not None else repr(backingMap)
+        self.prefix = prefix
+        self.isCacheable = isCacheable
+        
+    def subMap(self, prefix):
+        return CachingBucketMap(self.backingMap.subMap(prefix), self.cache, self.namespace, 
+                                self.prefix + prefix, self.isCacheable)
+    
+    def clone(self):
+        return self.subMap("")
+    
+    def cacheName(self, key):
+        """Name in the cache of the value for a key, or None if it isn't cached"""
+        fullKey = self.prefix + key
+        if self.isCacheable(fullKey):
+            return hashlib.sha1((u"%s\n%s" % (self.namespace, fullKey)).encode("utf-8")).hexdigest()
+        else:
+            return None
+        
+    def __getitem__(self, key):
+        cacheName = self.cacheName(key)
+        if cacheName is None:
+            return self.backingMap[key]
+        value = self.cache.get(cacheName)
+        if value is None:
+            value = self.backingMap[key]
+            self.cache.put(cacheName, value)
+        return value
+    
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+        
+    def getRange(self, key, start, end):
+        return self.backingMap.getRange(key, start, end)
+    
+    def __contains__(self, key):
+        cacheName = self.cacheName(key)
+        if cacheName is not None and cacheName in self.cache:
+            return True
+        return key in self.backingMap
+    
+    def cacheExistence(self):
+        self.backingMap.cacheExistence()
+        
+    def uncache(self, key):
+        cacheName = self.cacheName(key)
+        if cacheName is not None:
+            self.cache.remove(cacheName)
+            
+    def __setitem__(self, key, value):
+        self.uncache(key)
+        self.backingMap[key] = value
+        
+    def setFromStream(self, key, stream):
+        self.uncache(key)
+        self.backingMap.setFromStream(key, stream)
+        
+    def setFromFile(self, key, fileName):
+        self.uncache(key)
+        self.backingMap.setFromFile(key, fileName)
+        
+    def getToFile(self, key, fileName):
+        self.backingMap.getToFile(key, fileName)
+        
+    def __delitem__(self, key):
+        self.uncache(key)
+        del self.backingMap[key]
+        
+    def deleteMany(self, keys):
+        keys = list(keys)
+        for key in keys:
+            self.uncache(key)
+        self.backingMap.deleteMany(keys)
+        
+    def __iter__(self):
+        return iter(self.backingMap)
+    
+    def __repr__(self):
+        return "<CachingBucketMap, backing map:%r, prefix = \"%s\">" % (self.backingMap, self.prefix)
+    
+    def __str__(self):
+        return self.__repr__()
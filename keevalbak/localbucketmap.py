@@ -0,0 +1,414 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import urllib
+
+def utf8Encoded(string):
+    return unicode(string).encode('utf-8')
+
+def utf8Decoded(bytes):
+    return bytes.decode('utf-8')
+
+# Size of blocks in which values are copied to and from files
+CopyBlockSize = 1024 * 1024
+
+# Suffix of the names of files holding values (the quoting of key components never produces a '@', 
+# so that a key "a/b" (file "a/b@") and a key "a/b/c" (directory "a/b", file "a/b/c@") can both exist)
+ValueFileSuffix = "@"
+
+# Prefix of temporary files written before being atomically renamed to value files
+# (quoted key components never start with a '.', so these can't be confused with them)
+TempFilePrefix = ".tmp-"
+
+# Maximum length of the file name representing a key component (so that with the '@' suffix, or the
+# LongNamePrefix, a name is within the 255 byte limit of most file systems)
+MaxNameLength = 200
+
+# Separator between the start of a quoted component which is too long, and the SHA1 hash of the
+# whole component (the quoting never produces a '~')
+LongNameHashSeparator = "~"
+
+# Prefix of the files recording the whole key component represented by a long name
+# (e.g. the file ".name-abc~<hash>" records the component represented by "abc~<hash>" and "abc~<hash>@")
+LongNamePrefix = ".name-"
+
+def quoteComponent(component):
+    """File name representing a '/'-separated component of a key. If the quoted component
+    would be longer than MaxNameLength, the name is the start of it followed by the SHA1 hash
+    of the whole component (see isLongName), and the component itself is recorded in a separate file."""
+    if component == "":
+        return "%"
+    quoted = urllib.quote(utf8Encoded(component), safe = "")
+    if quoted.startswith("."):
+        quoted = "%2E" + quoted[1:]
+    if len(quoted) > MaxNameLength:
+        hash = hashlib.sha1(utf8Encoded(component)).hexdigest()
+        quoted = quoted[:MaxNameLength - len(hash) - 1] + LongNameHashSeparator + hash
+    return quoted
+    
+def isLongName(name):
+    """Does a file name (from quoteComponent) represent a component which was too long to quote in full?"""
+    return LongNameHashSeparator in name
+
+def unquoteComponent(name):
+    """Key component represented by a file name (inverse of quoteComponent, except for long names)"""
+    if name == "%":
+        return u""
+    else:
+        return utf8Decoded(urllib.unquote(name))
+
+def writeFileAtomically(fileName, bytes):
+    """Write a file by writing a temporary file which is then renamed"""
+    fd, tempFileName = tempfile.mkstemp(dir = os.path.dirname(fileName), prefix = TempFilePrefix)
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(bytes)
+        finally:
+            f.close()
+        if os.name == "nt" and os.path.exists(fileName):
+            os.remove(fileName)
+        os.rename(tempFileName, fileName)
+    except:
+        if os.path.exists(tempFileName):
+            os.remove(tempFileName)
+        raise
+    
+class DirectoryBucketMap(object):
+    """Implementation of the same map methods as S3BucketMap, with the values stored as files in 
+    a directory on a local (or network) file system, e.g. for backing up to a local disk or NAS, 
+    or for testing without an S3 bucket.
+    
+    Each key is split into '/'-separated components, where every component except the last is a
+    sub-directory, and the last is the name of the file holding the value (with the suffix '@'), 
+    all quoted so that any characters can be used. For example, with a prefix "myprefix/", 
+    the key "a b/c" is stored in the file "<root>/myprefix/a%20b/c@".
+    
+    A component whose quoted name would be too long for the file system is represented by the start
+    of the quoted name and the SHA1 hash of the component, with the component itself recorded in a
+    file next to it (see quoteComponent), so that keys can still be listed.
+    
+    Values are written to temporary files which are then renamed, so that a value is never seen
+    partly written. All the methods can be called from any thread.
+    """
+    
+    def __init__(self, root, prefix = ""):
+        self.root = os.path.abspath(root)
+        self.prefix = prefix
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        
+    def subMap(self, prefix):
+        return DirectoryBucketMap(self.root, self.prefix + prefix)
+    
+    def clone(self):
+        return self.subMap("")
+    
+    def valueFileName(self, key):
+        """Name of the file holding the value for a key"""
+        components = (self.prefix + key).split("/")
+        return os.path.join(self.root, *([quoteComponent(component) for component in components[:-1]] + 
+                                         [quoteComponent(components[-1]) + ValueFileSuffix]))
+    
+    def __getitem__(self, key):
+        try:
+            f = file(self.valueFileName(key), "rb")
+        except IOError:
+            raise KeyError(u"%s" % key)
+        try:
+            return f.read()
+        finally:
+            f.close()
+            
+    def getRange(self, key, start, end):
+        """Get the bytes [start, end) of the value for a key"""
+        try:
+            f = file(self.valueFileName(key), "rb")
+        except IOError:
+            raise KeyError(u"%s" % key)
+        try:
+            f.seek(start)
+            return f.read(end - start)
+        finally:
+            f.close()
+    
+    def get(self, key, default = None):
+        """Get the value for a key, or default if it doesn't exist"""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+        
+    def __contains__(self, key):
+        return os.path.isfile(self.valueFileName(key))
+    
+    def cacheExistence(self):
+        """(Does nothing, because checking if a file exists is already cheap, see BaseS3BucketMap.cacheExistence)"""
+        pass
+    
+    def recordLongNames(self, key):
+        """Record the components of a key which are represented by long names (see quoteComponent),
+        creating the directories of the key as they are needed"""
+        directory = self.root
+        components = (self.prefix + key).split("/")
+        for i, component in enumerate(components):
+            name = quoteComponent(component)
+            if isLongName(name):
+                longNameFileName = os.path.join(directory, LongNamePrefix + name)
+                if not os.path.exists(longNameFileName):
+                    writeFileAtomically(longNameFileName, utf8Encoded(component))
+            if i < len(components) - 1:
+                directory = os.path.join(directory, name)
+                if not os.path.isdir(directory):
+                    try:
+                        os.mkdir(directory)
+                    except OSError:
+                        if not os.path.isdir(directory): # (unless another thread just made it)
+                            raise
+                    
+    def readLongName(self, directory, name):
+        """The key component represented by a long name in a directory (or None if it isn't recorded, yet)"""
+        try:
+            f = file(os.path.join(directory, LongNamePrefix + name), "rb")
+        except IOError:
+            return None
+        try:
+            return utf8Decoded(f.read())
+        finally:
+            f.close()
+            
+    def removeLongName(self, directory, name):
+        """Remove the record of a long name in a directory, if nothing (a value or a sub-directory) still uses it"""
+        if isLongName(name):
+            if not os.path.exists(os.path.join(directory, name)) and \
+                    not os.path.exists(os.path.join(directory, name + ValueFileSuffix)):
+                try:
+                    os.remove(os.path.join(directory, LongNamePrefix + name))
+                except OSError:
+                    pass
+                
+    def writeValue(self, key, write):
+        """Write a value by calling write(f) on a temporary file, which then replaces the value file"""
+        fileName = self.valueFileName(key)
+        directory = os.path.dirname(fileName)
+        self.recordLongNames(key)
+        fd, tempFileName = tempfile.mkstemp(dir = directory, prefix = TempFilePrefix)
+        try:
+            f = os.fdopen(fd, "wb")
+            try:
+                write(f)
+            finally:
+                f.close()
+            if os.name == "nt" and os.path.exists(fileName):
+                os.remove(fileName)
+            os.rename(tempFileName, fileName)
+        except:
+            if os.path.exists(tempFileName):
+                os.remove(tempFileName)
+            raise
+    
+    def __setitem__(self, key, value):
+        if not isinstance(value, str):
+            raise TypeError('Cannot store non-string value')
+        self.writeValue(key, lambda f: f.write(value))
+        
+    def setFromStream(self, key, stream):
+        """Set the value for a key to everything read from a file-like object"""
+        self.writeValue(key, lambda f: shutil.copyfileobj(stream, f, CopyBlockSize))
+        
+    def setFromFile(self, key, fileName):
+        """Set the value for a key to the contents of a named file"""
+        inFile = file(fileName, "rb")
+        try:
+            self.setFromStream(key, inFile)
+        finally:
+            inFile.close()
+            
+    def getToFile(self, key, fileName):
+        """Write the value for a key into a named file"""
+        try:
+            inFile = file(self.valueFileName(key), "rb")
+        except IOError:
+            raise KeyError(u"%s" % key)
+        try:
+            outFile = file(fileName, "wb")
+            try:
+                shutil.copyfileobj(inFile, outFile, CopyBlockSize)
+            finally:
+                outFile.close()
+        finally:
+            inFile.close()
+    
+    def __delitem__(self, key):
+        # like S3BucketMap, this does not raise KeyError if the key doesn't exist
+        fileName = self.valueFileName(key)
+        try:
+            os.remove(fileName)
+        except OSError:
+            return
+        self.removeLongName(os.path.dirname(fileName), os.path.basename(fileName)[:-len(ValueFileSuffix)])
+        self.removeEmptyDirectories(os.path.dirname(fileName))
+        
+    def deleteMany(self, keys):
+        """Delete a number of keys"""
+        for key in keys:
+            del self[key]
+            
+    def removeEmptyDirectories(self, directory):
+        """Remove a directory, and then it's parents, for as long as they are empty (but not the root)"""
+        while directory != self.root and directory.startswith(self.root):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                return
+            self.removeLongName(os.path.dirname(directory), os.path.basename(directory))
+            directory = os.path.dirname(directory)
+            
+    def __iter__(self):
+        """Yield all keys (relative to the prefix), only looking in the directory containing
+        all keys starting with the prefix"""
+        components = self.prefix.split("/")
+        directory = os.path.join(self.root, *[quoteComponent(component) for component in components[:-1]])
+        keyBase = "/".join(components[:-1])
+        if keyBase != "":
+            keyBase += "/"
+        for key in self.iterDirectory(directory, keyBase, components[-1]):
+            yield key[len(self.prefix):]
+            
+    def iterDirectory(self, directory, keyBase, namePrefix = u""):
+        """Yield keys of values in a directory whose key components start with namePrefix, 
+        where keyBase is the key of the directory (with a trailing '/')"""
+        try:
+            names = sorted(os.listdir(directory))
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(TempFilePrefix) or name.startswith(LongNamePrefix):
+                continue
+            path = os.path.join(directory, name)
+            isValue = name.endswith(ValueFileSuffix)
+            if isValue:
+                name = name[:-len(ValueFileSuffix)]
+            if isLongName(name):
+                component = self.readLongName(directory, name)
+                if component is None:
+                    continue
+            else:
+                component = unquoteComponent(name)
+            if isValue:
+                if component.startswith(namePrefix):
+                    yield keyBase + component
+            else:
+                if component.startswith(namePrefix) and os.path.isdir(path):
+                    for key in self.iterDirectory(path, keyBase + component + "/"):
+                        yield key
+                        
+    def __repr__(self):
+        return "<DirectoryBucketMap, root:%s, prefix = \"%s\">" % (self.root, self.prefix)
+    
+    def __str__(self):
+        return self.__repr__()
+    
+class InMemoryBucketMap(object):
+    """Implementation of the same map methods as S3BucketMap, with the values held in memory, 
+    for testing (a map and all it's sub-maps and clones share the same values)."""
+    
+    def __init__(self, prefix = "", values = None, lock = None):
+        self.prefix = prefix
+        self.values = values if values is not None else {}
+        self.lock = lock or threading.Lock()
+        
+    def subMap(self, prefix):
+        return InMemoryBucketMap(self.prefix + prefix, self.values, self.lock)
+    
+    def clone(self):
+        return self.subMap("")
+    
+    def __getitem__(self, key):
+        with self.lock:
+            if self.prefix + key not in self.values:
+                raise KeyError(u"%s" % key)
+            return self.values[self.prefix + key]
+        
+    def getRange(self, key, start, end):
+        """Get the bytes [start, end) of the value for a key"""
+        return self[key][start:end]
+    
+    def get(self, key, default = None):
+        with self.lock:
+            return self.values.get(self.prefix + key, default)
+        
+    def __contains__(self, key):
+        with self.lock:
+            return self.prefix + key in self.values
+    
+    def cacheExistence(self):
+        pass
+    
+    def __setitem__(self, key, value):
+        if not isinstance(value, str):
+            raise TypeError('Cannot store non-string value')
+        with self.lock:
+            self.values[self.prefix + key] = value
+            
+    def setFromStream(self, key, stream):
+        self[key] = stream.read()
+        
+    def setFromFile(self, key, fileName):
+        f = file(fileName, "rb")
+        try:
+            self.setFromStream(key, f)
+        finally:
+            f.close()
+            
+    def getToFile(self, key, fileName):
+        value = self[key]
+        f = file(fileName, "wb")
+        try:
+            f.write(value)
+        finally:
+            f.close()
+        
+    def __delitem__(self, key):
+        with self.lock:
+            self.values.pop(self.prefix + key, None)
+            
+    def deleteMany(self, keys):
+        """Delete a number of keys"""
+        with self.lock:
+            for key in keys:
+                self.values.pop(self.prefix + key, None)
+                
+    def __iter__(self):
+        with self.lock:
+            keys = sorted(key for key in self.values if key.startswith(self.prefix))
+        for key in keys:
+            yield key[len(self.prefix):]
+            
+    def __repr__(self):
+        return "<InMemoryBucketMap, prefix = \"%s\">" % self.prefix
+    
+    def __str__(self):
+        return self.__repr__()
@@ -18,9 +18,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from boto.s3.connection import S3Connection
+import os
+import Queue
+import threading
+import time
+from contextlib import contextmanager
+from cStringIO import StringIO
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
 from boto.s3.bucketlistresultset import BucketListResultSet
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
+from boto.exception import S3ResponseError
+from RateLimiter import transferCallback
 
 def utf8Encoded(string):
     return unicode(string).encode('utf-8')
@@ -28,52 +37,461 @@ def utf8Encoded(string):
 def utf8Decoded(bytes):
     return bytes.decode('utf-8')
 
+# Values at least this many bytes long are uploaded as S3 multipart uploads, 
+# and downloaded as several byte ranges at once
+DefaultMultipartThreshold = 64 * 1024 * 1024
+
+# Size of each part of a multipart upload (S3 requires at least 5MB for all but the last part),
+# and of each byte range of a ranged download
+DefaultMultipartPartSize = 16 * 1024 * 1024
+
+# Number of parts or ranges of one value uploaded or downloaded at once
+DefaultMultipartThreads = 4
+
+# S3 does not allow more parts than this in one multipart upload
+MaxMultipartParts = 10000
+
+# Number of times transfer of a single part or range is attempted before the whole transfer fails
+PartTransferAttempts = 3
+
+# Size of blocks in which downloaded values are written to files
+DownloadChunkSize = 1024 * 1024
+
+# S3 does not allow more keys than this to be deleted by one multi-object delete request
+MaxDeleteBatchSize = 1000
+
+# Error codes of keys not deleted by a multi-object delete for which the delete may succeed if tried again
+TransientDeleteErrorCodes = set(["InternalError", "ServiceUnavailable", "SlowDown"])
+
+class MultiDeleteError(Exception):
+    """Some keys were not deleted by a multi-object delete (where the status is 503 if all the
+    errors were ones that might not happen if tried again, see ThreadedTaskRunner.isTransientError)"""
+    def __init__(self, errors):
+        Exception.__init__(self, "%d keys not deleted, first error %s: %s (key %r)" % 
+                           (len(errors), errors[0].code, errors[0].message, errors[0].key))
+        self.errors = errors
+        if all(error.code in TransientDeleteErrorCodes for error in errors):
+            self.status = 503
+        else:
+            self.status = None
+
+# Maximum number of idle connections kept by a connection pool
+DefaultConnectionPoolSize = 64
+
+# Idle connections are not reused after this many seconds (S3 closes idle keep-alive connections)
+MaxConnectionIdleTime = 15.0
+
+class BucketConnectionPool(object):
+    """Thread-safe pool of S3 connections (each one represented by the bucket object on that connection), 
+    so that connections (and their keep-alive HTTP connections) are reused, instead of each thread
+    needing it's own. Connections are created as needed, but at most maxIdle idle connections are kept.
+    A connection is not returned to the pool if a network error happened while it was being used
+    (i.e. anything other than a KeyError or an S3 error response), or reused if it has been idle for
+    more than maxIdleTime seconds."""
+    def __init__(self, newBucket, maxIdle = DefaultConnectionPoolSize, maxIdleTime = MaxConnectionIdleTime):
+        self.newBucket = newBucket
+        self.maxIdle = maxIdle
+        self.maxIdleTime = maxIdleTime
+        self.idleBuckets = []
+        self.lock = threading.Lock()
+        
+    def borrow(self):
+        """Take a connection's bucket from the pool (or a new one if there are no usable idle connections)"""
+        now = time.time()
+        with self.lock:
+            while self.idleBuckets:
+                bucket, idleSince = self.idleBuckets.pop()
+                if now - idleSince <= self.maxIdleTime:
+                    return bucket
+        return self.newBucket()
+    
+    def giveBack(self, bucket):
+        with self.lock:
+            if len(self.idleBuckets) < self.maxIdle:
+                self.idleBuckets.append ((bucket, time.time()))
+                
+    @contextmanager
+    def bucket(self):
+        """Borrow a connection's bucket for the duration of a 'with' block"""
+        bucket = self.borrow()
+        try:
+            yield bucket
+        except (KeyError, S3ResponseError):
+            self.giveBack(bucket)
+            raise
+        self.giveBack(bucket)
+        
 class BaseS3BucketMap(object):
-    def __init__(self, s3Connection, bucketName, prefix = ""):
+    def __init__(self, s3Connection, bucketName, prefix = "", multipartThreshold = DefaultMultipartThreshold, 
+                 multipartPartSize = DefaultMultipartPartSize, multipartThreads = DefaultMultipartThreads, 
+                 connectionPool = None, connectionPoolSize = DefaultConnectionPoolSize, 
+                 uploadLimiter = None, downloadLimiter = None):
+        """Map on an S3 bucket. Connections are taken from the connection pool as they are needed
+        (a new pool, which re-uses the credentials of s3Connection, is created if none is given).
+        Sub-maps share their parent's connection pool, and all map operations may be done from any thread.
+        If uploadLimiter or downloadLimiter (RateLimiter) are given, they limit the total rate at which 
+        values are uploaded or downloaded (shared with sub-maps, and any other maps given the same limiters)."""
         self.s3Connection = s3Connection
-        self.bucket = self.s3Connection.get_bucket(bucketName)
         self.bucketName = bucketName
         self.prefix = prefix
+        self.multipartThreshold = multipartThreshold
+        self.multipartPartSize = multipartPartSize
+        self.multipartThreads = multipartThreads
+        self.connectionPoolSize = connectionPoolSize
+        if connectionPool is None:
+            connectionPool = BucketConnectionPool(self.newBucket, maxIdle = connectionPoolSize)
+        self.connectionPool = connectionPool
+        self.uploadLimiter = uploadLimiter
+        self.downloadLimiter = downloadLimiter
+        self.existingKeys = None
         
     def bucketKey(self, key):
         return utf8Encoded(self.prefix + key)
         
     def subMap(self, prefix):
-        return BaseS3BucketMap(self.s3Connection, self.bucketName, self.prefix + prefix)
+        return BaseS3BucketMap(self.s3Connection, self.bucketName, self.prefix + prefix, 
+                               multipartThreshold = self.multipartThreshold, 
+                               multipartPartSize = self.multipartPartSize, 
+                               multipartThreads = self.multipartThreads, 
+                               connectionPool = self.connectionPool, 
+                               uploadLimiter = self.uploadLimiter, downloadLimiter = self.downloadLimiter)
+    
+    def clone(self):
+        """Same map (sharing the same connection pool)"""
+        return self.subMap("")
+    
+    def newBucket(self):
+        """Get the bucket on a new connection (without a request to check that it exists)"""
+        s3Connection = S3Connection(self.s3Connection.aws_access_key_id, 
+                                    self.s3Connection.aws_secret_access_key, 
+                                    self.s3Connection.is_secure)
+        return s3Connection.get_bucket(self.bucketName, validate = False)
         
     def __getitem__(self, key):
-        valueKey = self.bucket.lookup(self.bucketKey(key))
-        if valueKey is None: 
-            raise KeyError(u"%s" % key)
-        return valueKey.get_contents_as_string()
+        """Get the value for a key, with a single GET request (raising KeyError if it doesn't exist)"""
+        with self.connectionPool.bucket() as bucket:
+            valueKey = Key(bucket)
+            valueKey.name = self.bucketKey(key)
+            try:
+                return valueKey.get_contents_as_string(cb = transferCallback(self.downloadLimiter), num_cb = -1)
+            except S3ResponseError, e:
+                if e.status == 404:
+                    raise KeyError(u"%s" % key)
+                raise
+            
+    def get(self, key, default = None):
+        """Get the value for a key, or default if it doesn't exist (with one request either way, 
+        unlike checking 'key in map' before getting 'map[key]')"""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+        
+    def getRange(self, key, start, end):
+        """Get the bytes [start, end) of the value for a key 
+        (an empty range is not requested, because S3 ignores an invalid Range header and returns the whole value)"""
+        if end <= start:
+            return ""
+        with self.connectionPool.bucket() as bucket:
+            valueKey = Key(bucket)
+            valueKey.name = self.bucketKey(key)
+            try:
+                return valueKey.get_contents_as_string(headers = {"Range": "bytes=%d-%d" % (start, end-1)}, 
+                                                       cb = transferCallback(self.downloadLimiter), num_cb = -1)
+            except S3ResponseError, e:
+                if e.status == 404:
+                    raise KeyError(u"%s" % key)
+                raise
     
     def __contains__(self, key):
-        return self.bucket.lookup(self.bucketKey(key)) is not None
+        """Does a key exist? (answered from the existence cache if there is one, see cacheExistence, 
+        otherwise with a HEAD request)"""
+        if self.existingKeys is not None:
+            return key in self.existingKeys
+        with self.connectionPool.bucket() as bucket:
+            return bucket.lookup(self.bucketKey(key)) is not None
+        
+    def cacheExistence(self):
+        """List all the keys in this map once, so that from now on __contains__ can be answered 
+        for any number of keys without a request for each one. The cache is kept up to date
+        with keys set or deleted through this map object (but not through other map objects, 
+        including sub-maps and clones, which start without a cache, or by other processes).
+        This is opt-in only: BackupOperations doesn't call it, because it reads backup records with get, 
+        which needs no existence check (see S3BucketMapExample for a caller checking many keys)."""
+        self.existingKeys = set(self)
+        
+    def keyWritten(self, key):
+        if self.existingKeys is not None:
+            self.existingKeys.add (key)
     
     def __setitem__(self, key, value):
-        valueKey = Key(self.bucket)
-        valueKey.name = self.bucketKey(key)
         if not isinstance(value, str):
             raise TypeError('Cannot store non-string value')
-        valueKey.set_contents_from_string(value)
+        with self.connectionPool.bucket() as bucket:
+            valueKey = Key(bucket)
+            valueKey.name = self.bucketKey(key)
+            valueKey.set_contents_from_string(value, cb = transferCallback(self.uploadLimiter), num_cb = -1)
+        self.keyWritten(key)
+        
+    def setFromFile(self, key, fileName):
+        """Set the value for a key to the contents of a named file, without reading the
+        whole file into memory. Files of at least multipartThreshold bytes are uploaded
+        in parts, several at a time (see uploadParts)."""
+        size = os.path.getsize(fileName)
+        if size < self.multipartThreshold:
+            f = file(fileName, "rb")
+            try:
+                with self.connectionPool.bucket() as bucket:
+                    valueKey = Key(bucket)
+                    valueKey.name = self.bucketKey(key)
+                    valueKey.set_contents_from_file(f, cb = transferCallback(self.uploadLimiter), num_cb = -1)
+            finally:
+                f.close()
+            self.keyWritten(key)
+        else:
+            partSize = max(self.multipartPartSize, -(-size // MaxMultipartParts))
+            self.uploadParts(key, self.fileParts(fileName, size, partSize))
+            
+    def fileParts(self, fileName, size, partSize):
+        """Parts of a file to upload, where each part is opened separately (by the thread that uploads it)"""
+        partNum = 1
+        for offset in xrange(0, size, partSize):
+            yield (partNum, FilePart(fileName, offset, min(partSize, size - offset)))
+            partNum += 1
+    
+    def setFromStream(self, key, stream):
+        """Set the value for a key to everything read from a file-like object, holding at most 
+        a few parts of size multipartPartSize in memory at once. Content which fits
+        in one part is uploaded as a single value, otherwise a multipart upload is done."""
+        firstPart = stream.read(self.multipartPartSize)
+        if len(firstPart) < self.multipartPartSize:
+            self[key] = firstPart
+        else:
+            self.uploadParts(key, self.streamParts(firstPart, stream))
+            
+    def streamParts(self, firstPart, stream):
+        """Parts read from a stream, given the first part already read"""
+        partNum = 1
+        part = firstPart
+        while part:
+            yield (partNum, StringPart(part))
+            partNum += 1
+            part = stream.read(self.multipartPartSize)
+            
+    def uploadParts(self, key, parts):
+        """Do a multipart upload of value for a key, where parts yields (partNum, part), and
+        part.open() returns a file-like object positioned at the start of the part, and part.size is it's size.
+        Parts are uploaded by multipartThreads threads, each with a connection from the pool, and
+        a failed part is retried (up to PartUploadAttempts times) without restarting the whole upload.
+        If a part cannot be uploaded, the multipart upload is cancelled, and the error is raised."""
+        bucketKey = self.bucketKey(key)
+        with self.connectionPool.bucket() as bucket:
+            multipartUpload = bucket.initiate_multipart_upload(bucketKey)
+        partQueue = Queue.Queue(self.multipartThreads)
+        errors = []
+        def uploadQueuedParts():
+            while True:
+                queuedPart = partQueue.get()
+                if queuedPart is None:
+                    break
+                if not errors:
+                    partNum, part = queuedPart
+                    try:
+                        with self.connectionPool.bucket() as bucket:
+                            threadUpload = MultiPartUpload(bucket)
+                            threadUpload.key_name = bucketKey
+                            threadUpload.id = multipartUpload.id
+                            uploadPart(threadUpload, partNum, part, self.uploadLimiter)
+                    except Exception, e:
+                        errors.append (e)
+
+        threads = startThreads(self.multipartThreads, uploadQueuedParts)
+        try:
+            try:
+                for partNumAndPart in parts:
+                    if errors:
+                        break
+                    partQueue.put (partNumAndPart)
+            finally:
+                for thread in threads:
+                    partQueue.put (None)
+                for thread in threads:
+                    thread.join()
+            if errors:
+                raise errors[0]
+            with self.connectionPool.bucket() as bucket:
+                multipartUpload.bucket = bucket
+                multipartUpload.complete_upload()
+            self.keyWritten(key)
+        except:
+            with self.connectionPool.bucket() as bucket:
+                multipartUpload.bucket = bucket
+                multipartUpload.cancel_upload()
+            raise
+        
+    def getToFile(self, key, fileName):
+        """Write the value for a key into a named file, a block at a time, so that the
+        whole value is never held in memory. Values of at least multipartThreshold bytes
+        are downloaded as byte ranges of multipartPartSize, multipartThreads ranges at once."""
+        with self.connectionPool.bucket() as bucket:
+            valueKey = bucket.get_key(self.bucketKey(key))
+            if valueKey is None: 
+                raise KeyError(u"%s" % key)
+            if valueKey.size < self.multipartThreshold:
+                f = file(fileName, "wb")
+                try:
+                    valueKey.get_contents_to_file(f, cb = transferCallback(self.downloadLimiter), num_cb = -1)
+                finally:
+                    f.close()
+                return
+        self.downloadRanges(valueKey, fileName)
+            
+    def downloadRanges(self, valueKey, fileName):
+        """Download a value into a named file as byte ranges in parallel, where each thread
+        uses a connection from the pool and writes it's ranges directly into the file.
+        A failed range is retried (up to PartTransferAttempts times) without restarting the whole download."""
+        size = valueKey.size
+        f = file(fileName, "wb")
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+        rangeQueue = Queue.Queue()
+        for offset in xrange(0, size, self.multipartPartSize):
+            rangeQueue.put ((offset, min(offset + self.multipartPartSize, size)))
+        errors = []
+        def downloadQueuedRanges():
+            try:
+                with self.connectionPool.bucket() as bucket:
+                    while not errors:
+                        try:
+                            start, end = rangeQueue.get_nowait()
+                        except Queue.Empty:
+                            break
+                        downloadRange(bucket, valueKey, fileName, start, end, self.downloadLimiter)
+            except Exception, e:
+                errors.append (e)
+        threads = startThreads(self.multipartThreads, downloadQueuedRanges)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
     
     def __delitem__(self, key):
         # this does not return any KeyError if the key doesn't exist
         # (and it would cost more to check, so it doesn't check)
-        self.bucket.delete_key(self.bucketKey(key))
+        with self.connectionPool.bucket() as bucket:
+            bucket.delete_key(self.bucketKey(key))
+        if self.existingKeys is not None:
+            self.existingKeys.discard(key)
 
+    def deleteMany(self, keys):
+        """Delete a number of keys, using multi-object delete requests of up to MaxDeleteBatchSize keys each
+        (as for __delitem__, it is not an error for a key not to exist)"""
+        keys = list(keys)
+        bucketKeys = [self.bucketKey(key) for key in keys]
+        for start in xrange(0, len(bucketKeys), MaxDeleteBatchSize):
+            with self.connectionPool.bucket() as bucket:
+                result = bucket.delete_keys(bucketKeys[start:start + MaxDeleteBatchSize], quiet = True)
+            if result.errors:
+                raise MultiDeleteError(result.errors)
+        if self.existingKeys is not None:
+            self.existingKeys.difference_update(keys)
+            
     def __iter__(self):
         utf8Prefix = utf8Encoded (self.prefix)
-        for s3Key in BucketListResultSet(self.bucket, prefix = utf8Prefix):
-            s3KeyString = str(s3Key.key)
-            if s3KeyString.startswith(utf8Prefix): # probably this check is unnecessary
-                yield utf8Decoded(s3KeyString)[len(self.prefix):]
+        # (the listing connection is held until the iteration finishes, or discarded if it doesn't finish)
+        with self.connectionPool.bucket() as bucket:
+            for s3Key in BucketListResultSet(bucket, prefix = utf8Prefix):
+                s3KeyString = str(s3Key.key)
+                if s3KeyString.startswith(utf8Prefix): # probably this check is unnecessary
+                    yield utf8Decoded(s3KeyString)[len(self.prefix):]
 
     def __repr__(self):
-        return "<S3BucketMap, bucket:%s, prefix = \"%s\">" % (self.bucketName, self.prefix)
+        # (the endpoint is included, because CachingBucketMap uses this to tell backup maps apart)
+        return "<S3BucketMap, endpoint:%s:%s, bucket:%s, prefix = \"%s\">" % (self.s3Connection.host, 
+                                                                             self.s3Connection.port, 
+                                                                             self.bucketName, self.prefix)
 
     def __str__(self):
         return self.__repr__()
+    
+class FilePart(object):
+    """A part of a file to be uploaded"""
+    def __init__(self, fileName, offset, size):
+        self.fileName = fileName
+        self.offset = offset
+        self.size = size
+        
+    def open(self):
+        f = file(self.fileName, "rb")
+        f.seek(self.offset)
+        return f
+    
+class StringPart(object):
+    """A part to be uploaded which has already been read into memory"""
+    def __init__(self, content):
+        self.content = content
+        self.size = len(content)
+        
+    def open(self):
+        return StringIO(self.content)
+    
+def startThreads(numThreads, target):
+    """Start a number of (daemon) threads all running the same function"""
+    threads = [threading.Thread(target = target) for i in range(numThreads)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    return threads
+    
+def withRetries(description, transfer):
+    """Call transfer(), retrying if it raises an exception (up to PartTransferAttempts attempts in total)"""
+    attempt = 1
+    while True:
+        try:
+            return transfer()
+        except Exception, e:
+            if attempt >= PartTransferAttempts:
+                raise
+            print "Retrying %s after error: %s" % (description, e)
+            attempt += 1
+    
+def uploadPart(multipartUpload, partNum, part, limiter = None):
+    """Upload one part of a multipart upload, retrying if necessary (and limiting the rate if limiter is given)"""
+    def transferPart():
+        partFile = part.open()
+        try:
+            multipartUpload.upload_part_from_file(partFile, partNum, size = part.size, 
+                                                  cb = transferCallback(limiter), num_cb = -1)
+        finally:
+            partFile.close()
+    withRetries("upload of part %d of %r" % (partNum, multipartUpload.key_name), transferPart)
+    
+def downloadRange(bucket, valueKey, fileName, start, end, limiter = None):
+    """Download the byte range [start, end) of a value into the same position in a named file, 
+    retrying if necessary (and limiting the rate if limiter is given). 
+    The download fails if the value has changed since valueKey was looked up."""
+    def transferRange():
+        rangeKey = Key(bucket, valueKey.name)
+        rangeKey.open_read(headers = {"Range": "bytes=%d-%d" % (start, end-1), 
+                                      "If-Match": valueKey.etag})
+        try:
+            f = file(fileName, "r+b")
+            try:
+                f.seek(start)
+                while True:
+                    chunk = rangeKey.read(DownloadChunkSize)
+                    if not chunk:
+                        break
+                    if limiter is not None:
+                        limiter.consume(len(chunk))
+                    f.write(chunk)
+            finally:
+                f.close()
+        finally:
+            rangeKey.close()
+    withRetries("download of bytes %d-%d of %r" % (start, end, valueKey.name), transferRange)
 
 class S3BucketMap(BaseS3BucketMap):
     """Simplest possible implementation of Python map methods using an Amazon S3 bucket, 
@@ -85,22 +503,46 @@ class S3BucketMap(BaseS3BucketMap):
     The implementation only stores values which are byte strings.
     """
     
-    def __init__(self, accessKey, secretAccessKey, bucketName, prefix = "", secure = True):
-        """Initialize using standard S3 bucket details and optional prefix"""
+    def __init__(self, accessKey, secretAccessKey, bucketName, prefix = "", secure = True, 
+                 multipartThreshold = DefaultMultipartThreshold, multipartPartSize = DefaultMultipartPartSize, 
+                 multipartThreads = DefaultMultipartThreads, host = None, port = None, 
+                 connectionPool = None, connectionPoolSize = DefaultConnectionPoolSize, 
+                 uploadLimiter = None, downloadLimiter = None):
+        """Initialize using standard S3 bucket details and optional prefix
+        (and optional settings for multipart uploads of large values, for the connection pool, 
+        and for limiting upload and download rates).
+        If host (and optionally port) are given, connect to that S3-compatible service
+        (e.g. a local stand-in for testing) instead of Amazon S3, using path-style bucket addressing."""
         self.accessKey = accessKey
         self.secretAccessKey = secretAccessKey
         self.bucketName = bucketName
         self.prefix = prefix
         self.secure = secure
-        s3Connection = S3Connection(accessKey, secretAccessKey, secure)
-        super(S3BucketMap, self).__init__(s3Connection, bucketName, prefix)
+        self.host = host
+        self.port = port
+        s3Connection = self.newConnection()
+        super(S3BucketMap, self).__init__(s3Connection, bucketName, prefix, 
+                                          multipartThreshold = multipartThreshold, 
+                                          multipartPartSize = multipartPartSize, 
+                                          multipartThreads = multipartThreads, 
+                                          connectionPool = connectionPool, connectionPoolSize = connectionPoolSize, 
+                                          uploadLimiter = uploadLimiter, downloadLimiter = downloadLimiter)
         
-    def clone(self):
-        return S3BucketMap(accessKey = self.accessKey, secretAccessKey = self.secretAccessKey, 
-                           bucketName = self.bucketName, prefix = self.prefix, 
-                           secure = self.secure)
-
     def subMap(self, prefix):
         return S3BucketMap(accessKey = self.accessKey, secretAccessKey = self.secretAccessKey, 
                            bucketName = self.bucketName, prefix = self.prefix + prefix, 
-                           secure = self.secure)
+                           secure = self.secure, multipartThreshold = self.multipartThreshold, 
+                           multipartPartSize = self.multipartPartSize, 
+                           multipartThreads = self.multipartThreads, host = self.host, port = self.port, 
+                           connectionPool = self.connectionPool, 
+                           uploadLimiter = self.uploadLimiter, downloadLimiter = self.downloadLimiter)
+    
+    def newConnection(self):
+        if self.host is None:
+            return S3Connection(self.accessKey, self.secretAccessKey, self.secure)
+        else:
+            return S3Connection(self.accessKey, self.secretAccessKey, self.secure, port = self.port, 
+                                host = self.host, calling_format = OrdinaryCallingFormat())
+    
+    def newBucket(self):
+        return self.newConnection().get_bucket(self.bucketName, validate = False)
@@ -0,0 +1,305 @@
+# Copyright (c) 2008 Philip Dorrell, http://www.1729.com/
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import random
+import threading
+import time
+
+class SimulatedRequestError(Exception):
+    """An error response from a simulated object store, with an HTTP status like a boto S3ResponseError
+    (so that statuses such as 503 are treated as transient, see ThreadedTaskRunner.isTransientError)"""
+    def __init__(self, status, reason):
+        Exception.__init__(self, "%d %s" % (status, reason))
+        self.status = status
+        self.reason = reason
+
+# Number of keys returned by each simulated listing request (as for S3)
+ListPageSize = 1000
+
+# Number of keys deleted by each simulated multi-object delete request (as for S3)
+DeleteBatchSize = 1000
+
+class StoreSimulation(object):
+    """Behaviour of a simulated remote object store, shared by a SimulatedBucketMap and all it's
+    sub-maps and clones, and counts of the requests made to it.
+    
+    Every request takes 'latency' seconds (plus a random extra of up to 'latencyJitter' seconds),
+    and all data sent or received shares a link of 'bandwidth' bytes per second (None for unlimited).
+    Each request fails with a "503 Slow Down" error with probability 'throttleRate', and also if
+    more than 'maxRequestRate' requests (None for no limit) have been made in the current second.
+    A throttled request is retried up to 'clientRetries' times (after a random delay of up to
+    2**retry seconds) before the error is raised, as boto does for S3 requests.
+    A value written does not become visible to reads or listings until 'consistencyDelay' seconds
+    after it was written (until then the previous value, if any, is seen instead).
+    If 'failWrite' is given, it is called with the full key of each value written, and if it returns True, 
+    the write fails with a (non-transient) "403 Forbidden" error, e.g. to interrupt a backup part way through.
+    """
+    
+    def __init__(self, latency = 0.05, latencyJitter = 0.0, bandwidth = None, throttleRate = 0.0, 
+                 maxRequestRate = None, clientRetries = 6, consistencyDelay = 0.0, randomSeed = None, 
+                 failWrite = None):
+        self.latency = latency
+        self.latencyJitter = latencyJitter
+        self.bandwidth = bandwidth
+        self.throttleRate = throttleRate
+        self.maxRequestRate = maxRequestRate
+        self.clientRetries = clientRetries
+        self.consistencyDelay = consistencyDelay
+        self.failWrite = failWrite
+        self.random = random.Random(randomSeed)
+        self.lock = threading.Lock()
+        self.linkFreeTime = 0.0
+        self.currentSecond = None
+        self.requestsThisSecond = 0
+        self.recentWrites = {}
+        self.resetCounts()
+    
+    def resetCounts(self):
+        with self.lock:
+            self.requestCounts = {}
+            self.bytesSent = 0
+            self.bytesReceived = 0
+            self.numThrottled = 0
+    
+    def counts(self):
+        """Snapshot of the counts of requests (by type), bytes sent and received, and throttled requests"""
+        with self.lock:
+            counts = dict(self.requestCounts)
+            counts["bytesSent"] = self.bytesSent
+            counts["bytesReceived"] = self.bytesReceived
+            counts["throttled"] = self.numThrottled
+            return counts
+    
+    def request(self, requestType):
+        """Make a request of the given type (e.g. "GET"), waiting for it's latency, and retrying
+        it if it is throttled"""
+        retry = 0
+        while True:
+            try:
+                self.singleRequest(requestType)
+                return
+            except SimulatedRequestError:
+                if retry >= self.clientRetries:
+                    raise
+                time.sleep(self.random.random() * 2 ** retry)
+                retry += 1
+                
+    def singleRequest(self, requestType):
+        """Make one attempt at a request, failing if it is throttled"""
+        with self.lock:
+            self.requestCounts[requestType] = self.requestCounts.get(requestType, 0) + 1
+            second = int(time.time())
+            if second != self.currentSecond:
+                self.currentSecond = second
+                self.requestsThisSecond = 0
+            self.requestsThisSecond += 1
+            throttled = (self.random.random() < self.throttleRate or 
+                         (self.maxRequestRate is not None and self.requestsThisSecond > self.maxRequestRate))
+            if throttled:
+                self.numThrottled += 1
+            delay = self.latency + self.random.random() * self.latencyJitter
+        if delay > 0:
+            time.sleep(delay)
+        if throttled:
+            raise SimulatedRequestError(503, "Slow Down")
+    
+    def transfer(self, numBytes, sent):
+        """Transfer data over the shared link, waiting until the link is free and the data has been sent"""
+        with self.lock:
+            if sent:
+                self.bytesSent += numBytes
+            else:
+                self.bytesReceived += numBytes
+            if not self.bandwidth:
+                return
+            startTime = max(time.time(), self.linkFreeTime)
+            self.linkFreeTime = startTime + float(numBytes) / self.bandwidth
+            finishTime = self.linkFreeTime
+        delay = finishTime - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    
+    def checkWrite(self, fullKey):
+        """Fail a write to a key if failWrite says that it should fail"""
+        if self.failWrite is not None and self.failWrite(fullKey):
+            raise SimulatedRequestError(403, "Forbidden")
+        
+    def recordWrite(self, fullKey, previousValue):
+        """Record a write to a key which had the previous value (or None) before it"""
+        if self.consistencyDelay > 0:
+            with self.lock:
+                if fullKey in self.recentWrites: # keep the value from before the earlier write
+                    previousValue = self.recentWrites[fullKey][1]
+                self.recentWrites[fullKey] = (time.time() + self.consistencyDelay, previousValue)
+    
+    def staleValue(self, fullKey):
+        """Return (True, previousValue) if the latest write to a key is not yet visible, otherwise (False, None)"""
+        if self.consistencyDelay <= 0:
+            return (False, None)
+        with self.lock:
+            write = self.recentWrites.get(fullKey)
+            if write is None:
+                return (False, None)
+            if write[0] <= time.time():
+                del self.recentWrites[fullKey]
+                return (False, None)
+            return (True, write[1])
+        
+class SimulatedBucketMap(object):
+    """Implementation of the same map methods as S3BucketMap, which stores values in another map
+    (e.g. an InMemoryBucketMap or DirectoryBucketMap), but makes requests to it behave like requests
+    to a remote object store (see StoreSimulation), for benchmarking and testing."""
+    
+    def __init__(self, backingMap, simulation = None, prefix = ""):
+        self.backingMap = backingMap
+        self.simulation = simulation or StoreSimulation()
+        self.prefix = prefix
+        self.existingKeys = None
+    
+    def subMap(self, prefix):
+        return SimulatedBucketMap(self.backingMap.subMap(prefix), self.simulation, self.prefix + prefix)
+    
+    def clone(self):
+        return self.subMap("")
+    
+    def __getitem__(self, key):
+        self.simulation.request("GET")
+        stale, previousValue = self.simulation.staleValue(self.prefix + key)
+        if stale:
+            if previousValue is None:
+                raise KeyError(u"%s" % key)
+            value = previousValue
+        else:
+            value = self.backingMap[key]
+        self.simulation.transfer(len(value), sent = False)
+        return value
+    
+    def getRange(self, key, start, end):
+        """Get the bytes [start, end) of the value for a key (with no request for an empty range, as for S3BucketMap)"""
+        if end <= start:
+            return ""
+        self.simulation.request("GET")
+        stale, previousValue = self.simulation.staleValue(self.prefix + key)
+        if stale:
+            if previousValue is None:
+                raise KeyError(u"%s" % key)
+            value = previousValue[start:end]
+        else:
+            value = self.backingMap.getRange(key, start, end)
+        self.simulation.transfer(len(value), sent = False)
+        return value
+    
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+        
+    def __contains__(self, key):
+        if self.existingKeys is not None:
+            return key in self.existingKeys
+        self.simulation.request("HEAD")
+        stale, previousValue = self.simulation.staleValue(self.prefix + key)
+        if stale:
+            return previousValue is not None
+        return key in self.backingMap
+    
+    def cacheExistence(self):
+        """List all the keys once, to answer __contains__ without requests (see BaseS3BucketMap.cacheExistence)"""
+        self.existingKeys = set(self)
+        
+    def keyWritten(self, key):
+        if self.existingKeys is not None:
+            self.existingKeys.add (key)
+            
+    def previousValue(self, key):
+        """The value for a key before it is written (only needed if writes are not immediately visible)"""
+        if self.simulation.consistencyDelay > 0 and key in self.backingMap:
+            return self.backingMap[key]
+        return None
+    
+    def __setitem__(self, key, value):
+        if not isinstance(value, str):
+            raise TypeError('Cannot store non-string value')
+        self.simulation.request("PUT")
+        self.simulation.checkWrite(self.prefix + key)
+        self.simulation.transfer(len(value), sent = True)
+        previousValue = self.previousValue(key)
+        self.backingMap[key] = value
+        self.simulation.recordWrite(self.prefix + key, previousValue)
+        self.keyWritten(key)
+    
+    def setFromStream(self, key, stream):
+        self[key] = stream.read()
+    
+    def setFromFile(self, key, fileName):
+        self.simulation.request("PUT")
+        self.simulation.checkWrite(self.prefix + key)
+        self.simulation.transfer(os.path.getsize(fileName), sent = True)
+        previousValue = self.previousValue(key)
+        self.backingMap.setFromFile(key, fileName)
+        self.simulation.recordWrite(self.prefix + key, previousValue)
+        self.keyWritten(key)
+    
+    def getToFile(self, key, fileName):
+        self.simulation.request("GET")
+        stale, previousValue = self.simulation.staleValue(self.prefix + key)
+        if stale:
+            if previousValue is None:
+                raise KeyError(u"%s" % key)
+            f = file(fileName, "wb")
+            try:
+                f.write(previousValue)
+            finally:
+                f.close()
+        else:
+            self.backingMap.getToFile(key, fileName)
+        self.simulation.transfer(os.path.getsize(fileName), sent = False)
+    
+    def __delitem__(self, key):
+        self.simulation.request("DELETE")
+        del self.backingMap[key]
+        if self.existingKeys is not None:
+            self.existingKeys.discard(key)
+    
+    def deleteMany(self, keys):
+        """Delete a number of keys, with one (multi-object delete) request per DeleteBatchSize keys"""
+        keys = list(keys)
+        for start in range(0, len(keys), DeleteBatchSize):
+            self.simulation.request("DELETE")
+            self.backingMap.deleteMany(keys[start:start + DeleteBatchSize])
+        if self.existingKeys is not None:
+            self.existingKeys.difference_update(keys)
+            
+    def __iter__(self):
+        keys = list(self.backingMap)
+        for pageStart in range(0, max(len(keys), 1), ListPageSize):
+            self.simulation.request("LIST")
+            for key in keys[pageStart:pageStart + ListPageSize]:
+                stale, previousValue = self.simulation.staleValue(self.prefix + key)
+                if not stale or previousValue is not None:
+                    yield key
+    
+    def __repr__(self):
+        return "<SimulatedBucketMap, backing map:%r, prefix = \"%s\">" % (self.backingMap, self.prefix)
+    
+    def __str__(self):
+        return self.__repr__()